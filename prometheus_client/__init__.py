@@ -22,6 +22,7 @@ Enum = metrics.Enum
 
 CONTENT_TYPE_LATEST = exposition.CONTENT_TYPE_LATEST
 generate_latest = exposition.generate_latest
+generate_latest_chunks = exposition.generate_latest_chunks
 MetricsHandler = exposition.MetricsHandler
 make_wsgi_app = exposition.make_wsgi_app
 start_http_server = exposition.start_http_server
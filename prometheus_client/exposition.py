@@ -4,13 +4,18 @@ from __future__ import unicode_literals
 
 import base64
 from contextlib import closing
+import itertools
 import os
 import socket
 import sys
 import threading
+import time
+import weakref
 from wsgiref.simple_server import make_server, WSGIRequestHandler
+import zlib
 
 from .openmetrics import exposition as openmetrics
+from .protobuf import exposition as protobuf
 from .registry import REGISTRY
 from .utils import floatToGoString
 
@@ -33,21 +38,105 @@ CONTENT_TYPE_LATEST = str('text/plain; version=0.0.4; charset=utf-8')
 PYTHON26_OR_OLDER = sys.version_info < (2, 7)
 
 
-def make_wsgi_app(registry=REGISTRY):
-    """Create a WSGI app which serves the metrics from a registry."""
+class _Flight(object):
+    """A collection in progress, which other requests can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _ScrapeCache(object):
+    """Caches encoded output for a number of seconds.
+
+    Concurrent requests for output that isn't cached wait for the one
+    request already producing it, rather than each producing it again.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._results = {}
+        self._flights = {}
+
+    def get(self, key, produce):
+        """Return the output cached for key, calling produce() if needed."""
+        with self._lock:
+            now = time.time()
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = produce()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None:
+                    now = time.time()
+                    # Drop expired output, which may be for filters never
+                    # asked for again.
+                    for k, (expiry, _) in list(self._results.items()):
+                        if expiry <= now:
+                            del self._results[k]
+                    self._results[key] = (now + self._ttl, flight.result)
+            flight.done.set()
+        return flight.result
+
+
+def make_wsgi_app(registry=REGISTRY, compression_level=6, cache_ttl=None):
+    """Create a WSGI app which serves the metrics from a registry.
+
+    Output is gzip or deflate compressed at `compression_level` for clients
+    accepting it, unless `compression_level` is None.
+
+    With a `cache_ttl` (in seconds), output is reused for that long by
+    requests for the same format and `name[]` filter, and requests arriving
+    while it's being produced wait for it rather than collecting again.
+    Cached output is held in memory whole rather than streamed.
+    """
+    cache = _ScrapeCache(cache_ttl) if cache_ttl else None
 
     def prometheus_app(environ, start_response):
         params = parse_qs(environ.get('QUERY_STRING', ''))
-        r = registry
         encoder, content_type = choose_encoder(environ.get('HTTP_ACCEPT'))
-        if 'name[]' in params:
-            r = r.restricted_registry(params['name[]'])
-        output = encoder(r)
+        names = params.get('name[]')
+
+        def produce():
+            r = registry
+            if names:
+                r = r.restricted_registry(names)
+            return chunked_encoder(encoder)(r)
+
+        if cache is not None:
+            key = (encoder, tuple(sorted(names)) if names else None)
+            output = iter(cache.get(key, lambda: list(produce())))
+        else:
+            # Stream the output, leaving it to the server to chunk it.
+            output = produce()
 
         status = str('200 OK')
         headers = [(str('Content-type'), content_type)]
+        if compression_level is not None:
+            headers.append((str('Vary'), str('Accept-Encoding')))
+            content_encoding = choose_content_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+            if content_encoding:
+                output = compress_chunks(output, content_encoding, compression_level)
+                headers.append((str('Content-Encoding'), str(content_encoding)))
         start_response(status, headers)
-        return [output]
+        return output
 
     return prometheus_app
 
@@ -59,35 +148,88 @@ class _SilentHandler(WSGIRequestHandler):
         """Log nothing."""
 
 
-def start_wsgi_server(port, addr='', registry=REGISTRY):
+def start_wsgi_server(port, addr='', registry=REGISTRY, compression_level=6, cache_ttl=None):
     """Starts a WSGI server for prometheus metrics as a daemon thread."""
-    app = make_wsgi_app(registry)
+    app = make_wsgi_app(registry, compression_level, cache_ttl)
     httpd = make_server(addr, port, app, handler_class=_SilentHandler)
     t = threading.Thread(target=httpd.serve_forever)
     t.daemon = True
     t.start()
 
 
+# Rendered "name{labels} " prefixes of sample lines by registry, as they
+# rarely change between scrapes. Each complete output keeps only the
+# prefixes it used, so the cache follows the series of the registry rather
+# than growing with label values that come and go, and goes with it.
+_prefix_caches = weakref.WeakKeyDictionary()
+_prefix_caches_lock = threading.Lock()
+
+
+def _render_prefix(name, labels):
+    if labels:
+        labelstr = '{{{0}}}'.format(','.join(
+            ['{0}="{1}"'.format(
+                k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+                for k, v in sorted(labels.items())]))
+    else:
+        labelstr = ''
+    return '{0}{1} '.format(name, labelstr)
+
+
+def _cached_prefixes(registry):
+    """Return the prefixes used by the last complete output of registry."""
+    with _prefix_caches_lock:
+        try:
+            return _prefix_caches.get(registry) or {}
+        except TypeError:
+            # Not weakly referenceable, so not cached.
+            return {}
+
+
+def _cache_prefixes(registry, prefixes):
+    with _prefix_caches_lock:
+        try:
+            _prefix_caches[registry] = prefixes
+        except TypeError:
+            pass
+
+
 def generate_latest(registry=REGISTRY):
     """Returns the metrics from the registry in latest text format as a string."""
+    return b''.join(generate_latest_chunks(registry))
+
+
+def generate_latest_chunks(registry=REGISTRY):
+    """Yields the metrics from the registry in latest text format.
+
+    Each chunk is the utf-8 encoded output of one metric family, so the
+    whole output never needs to be held in memory at once.
+    """
+    cache_key = registry._registry if isinstance(registry, _TimedRegistry) else registry
+    cached = _cached_prefixes(cache_key)
+    prefixes = {}
+
+    def sample_prefix(name, labels):
+        # Labels are rendered sorted, so the order they're in doesn't
+        # matter beyond possibly caching the same prefix twice.
+        key = (name, tuple(labels.items()))
+        prefix = prefixes.get(key)
+        if prefix is None:
+            prefix = cached.get(key)
+            if prefix is None:
+                prefix = _render_prefix(name, labels)
+            prefixes[key] = prefix
+        return prefix
 
     def sample_line(line):
-        if line.labels:
-            labelstr = '{{{0}}}'.format(','.join(
-                ['{0}="{1}"'.format(
-                    k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
-                    for k, v in sorted(line.labels.items())]))
-        else:
-            labelstr = ''
         timestamp = ''
         if line.timestamp is not None:
             # Convert to milliseconds.
             timestamp = ' {0:d}'.format(int(float(line.timestamp) * 1000))
-        return '{0}{1} {2}{3}\n'.format(
-            line.name, labelstr, floatToGoString(line.value), timestamp)
+        return sample_prefix(line.name, line.labels) + floatToGoString(line.value) + timestamp + '\n'
 
-    output = []
     for metric in registry.collect():
+        output = []
         try:
             mname = metric.name
             mtype = metric.type
@@ -126,21 +268,144 @@ def generate_latest(registry=REGISTRY):
         for suffix, lines in sorted(om_samples.items()):
             output.append('# TYPE {0}{1} gauge\n'.format(metric.name, suffix))
             output.extend(lines)
-    return ''.join(output).encode('utf-8')
+        yield ''.join(output).encode('utf-8')
+    _cache_prefixes(cache_key, prefixes)
 
 
 def choose_encoder(accept_header):
     accept_header = accept_header or ''
     for accepted in accept_header.split(','):
-        if accepted.split(';')[0].strip() == 'application/openmetrics-text':
+        parts = [p.strip() for p in accepted.split(';')]
+        if parts[0] == 'application/openmetrics-text':
             return (openmetrics.generate_latest,
                     openmetrics.CONTENT_TYPE_LATEST)
+        if (parts[0] == 'application/vnd.google.protobuf'
+                and 'proto=io.prometheus.client.MetricFamily' in parts
+                and 'encoding=delimited' in parts):
+            return (protobuf.generate_latest,
+                    protobuf.CONTENT_TYPE_LATEST)
     return generate_latest, CONTENT_TYPE_LATEST
 
 
+def choose_content_encoding(accept_encoding_header):
+    """Return 'gzip', 'deflate' or None, as accepted by the client."""
+    accepted = {}
+    for coding in (accept_encoding_header or '').split(','):
+        parts = coding.split(';')
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].strip().lower()] = q
+    for content_encoding in ('gzip', 'deflate'):
+        if accepted.get(content_encoding, accepted.get('*', 0)) > 0:
+            return content_encoding
+    return None
+
+
+def compress_chunks(chunks, content_encoding, level=6):
+    """Compress chunks of output for the 'gzip' or 'deflate' content encoding.
+
+    Compression is streamed, so chunks are yielded as the compressor emits
+    output rather than once all the input is compressed.
+    """
+    if content_encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    elif content_encoding == 'deflate':
+        wbits = zlib.MAX_WBITS
+    else:
+        raise ValueError('Unsupported content encoding: ' + content_encoding)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+_CHUNKED_ENCODERS = {
+    generate_latest: generate_latest_chunks,
+    openmetrics.generate_latest: openmetrics.generate_latest_chunks,
+    protobuf.generate_latest: protobuf.generate_latest_chunks,
+}
+
+
+_ENCODER_NAMES = {
+    generate_latest: 'text',
+    openmetrics.generate_latest: 'openmetrics',
+    protobuf.generate_latest: 'protobuf',
+}
+
+
+def chunked_encoder(encoder):
+    """Return a function yielding the output of encoder in chunks.
+
+    For encoders returned by choose_encoder, this streams their output a
+    metric family at a time. Any other encoder is given as a single chunk.
+
+    For instrumented registries, the time spent encoding rather than
+    collecting is recorded in the registry once the output is complete.
+    """
+    try:
+        chunks = _CHUNKED_ENCODERS[encoder]
+    except KeyError:
+        def chunks(registry):
+            return iter([encoder(registry)])
+    name = _ENCODER_NAMES.get(encoder) or getattr(encoder, '__name__', 'unknown')
+
+    def encode(registry):
+        if getattr(registry, '_instrument', False):
+            return _timed_chunks(chunks, registry, name)
+        return chunks(registry)
+    return encode
+
+
+class _TimedRegistry(object):
+    """Wraps a registry, adding up the time spent in its collect()."""
+
+    def __init__(self, registry):
+        self._registry = registry
+        self.duration = 0.0
+
+    def collect(self):
+        metrics = iter(self._registry.collect())
+        while True:
+            start = time.time()
+            try:
+                metric = next(metrics)
+            except StopIteration:
+                return
+            finally:
+                self.duration += time.time() - start
+            yield metric
+
+
+def _timed_chunks(chunks, registry, name):
+    timed = _TimedRegistry(registry)
+    output = chunks(timed)
+    duration = 0.0
+    while True:
+        # Only time spent producing chunks, not the caller writing them out.
+        start = time.time()
+        try:
+            chunk = next(output)
+        except StopIteration:
+            break
+        finally:
+            duration += time.time() - start
+        yield chunk
+    registry.record_encoding(name, duration - timed.duration)
+
+
 class MetricsHandler(BaseHTTPRequestHandler):
     """HTTP handler that gives metrics from ``REGISTRY``."""
     registry = REGISTRY
+    # Level to compress output at for clients accepting it, None to disable.
+    compression_level = 6
 
     def do_GET(self):
         registry = self.registry
@@ -148,23 +413,58 @@ class MetricsHandler(BaseHTTPRequestHandler):
         encoder, content_type = choose_encoder(self.headers.get('Accept'))
         if 'name[]' in params:
             registry = registry.restricted_registry(params['name[]'])
+        chunks = chunked_encoder(encoder)(registry)
+        content_encoding = None
+        if self.compression_level is not None:
+            content_encoding = choose_content_encoding(self.headers.get('Accept-Encoding'))
+            if content_encoding:
+                chunks = compress_chunks(chunks, content_encoding, self.compression_level)
         try:
-            output = encoder(registry)
+            # Errors up to the first metric family can still be reported.
+            first = next(chunks, b'')
         except:
             self.send_error(500, 'error generating metric output')
             raise
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            # Only for this response, as subclasses overriding do_GET may
+            # rely on the end of their output being marked by closing the
+            # connection, as it is with HTTP/1.0.
+            self.protocol_version = str('HTTP/1.1')
+            self.close_connection = self.headers.get('Connection', '').lower() == 'close'
         self.send_response(200)
         self.send_header('Content-Type', content_type)
+        if self.compression_level is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if content_encoding:
+            self.send_header('Content-Encoding', content_encoding)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # The end of the output is marked by closing the connection.
+            self.close_connection = True
         self.end_headers()
-        self.wfile.write(output)
+        try:
+            for chunk in itertools.chain([first], chunks):
+                if not chunk:
+                    continue
+                if chunked:
+                    chunk = '{0:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n'
+                self.wfile.write(chunk)
+        except:
+            # Too late for an error response, so truncate it instead.
+            self.close_connection = True
+            raise
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
 
     def log_message(self, format, *args):
         """Log nothing."""
 
     @classmethod
-    def factory(cls, registry):
+    def factory(cls, registry, compression_level=6):
         """Returns a dynamic MetricsHandler class tied
-           to the passed registry.
+           to the passed registry and compression level.
         """
         # This implementation relies on MetricsHandler.registry
         #  (defined above and defaulted to REGISTRY).
@@ -173,7 +473,7 @@ class MetricsHandler(BaseHTTPRequestHandler):
         #  object for type().
         cls_name = str(cls.__name__)
         MyMetricsHandler = type(cls_name, (cls, object),
-                                {"registry": registry})
+                                {"registry": registry, "compression_level": compression_level})
         return MyMetricsHandler
 
 
@@ -187,9 +487,9 @@ class _ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
 
 
-def start_http_server(port, addr='', registry=REGISTRY):
+def start_http_server(port, addr='', registry=REGISTRY, compression_level=6):
     """Starts an HTTP server for prometheus metrics as a daemon thread"""
-    CustomMetricsHandler = MetricsHandler.factory(registry)
+    CustomMetricsHandler = MetricsHandler.factory(registry, compression_level)
     httpd = _ThreadingSimpleServer((addr, port), CustomMetricsHandler)
     t = threading.Thread(target=httpd.serve_forever)
     t.daemon = True
@@ -247,7 +547,7 @@ def basic_auth_handler(url, method, timeout, headers, data, username=None, passw
 
 def push_to_gateway(
         gateway, job, registry, grouping_key=None, timeout=30,
-        handler=default_handler):
+        handler=default_handler, compression=None):
     """Push metrics to the given pushgateway.
 
     `gateway` the url for your push gateway. Either of the form
@@ -283,15 +583,17 @@ def push_to_gateway(
               failure.
               'content' is the data which should be used to form the HTTP
               Message Body.
+    `compression` is 'gzip' to compress the pushed metrics, which the
+              pushgateway accepts. Defaults to None, for no compression.
 
     This overwrites all metrics with the same job and grouping_key.
     This uses the PUT HTTP method."""
-    _use_gateway('PUT', gateway, job, registry, grouping_key, timeout, handler)
+    _use_gateway('PUT', gateway, job, registry, grouping_key, timeout, handler, compression)
 
 
 def pushadd_to_gateway(
         gateway, job, registry, grouping_key=None, timeout=30,
-        handler=default_handler):
+        handler=default_handler, compression=None):
     """PushAdd metrics to the given pushgateway.
 
     `gateway` the url for your push gateway. Either of the form
@@ -309,10 +611,12 @@ def pushadd_to_gateway(
               will be carried out by a default handler.
               See the 'prometheus_client.push_to_gateway' documentation
               for implementation requirements.
+    `compression` is 'gzip' to compress the pushed metrics, which the
+              pushgateway accepts. Defaults to None, for no compression.
 
     This replaces metrics with the same name, job and grouping_key.
     This uses the POST HTTP method."""
-    _use_gateway('POST', gateway, job, registry, grouping_key, timeout, handler)
+    _use_gateway('POST', gateway, job, registry, grouping_key, timeout, handler, compression)
 
 
 def delete_from_gateway(
@@ -339,15 +643,21 @@ def delete_from_gateway(
     _use_gateway('DELETE', gateway, job, None, grouping_key, timeout, handler)
 
 
-def _use_gateway(method, gateway, job, registry, grouping_key, timeout, handler):
+def _use_gateway(method, gateway, job, registry, grouping_key, timeout, handler, compression=None):
     gateway_url = urlparse(gateway)
     if not gateway_url.scheme or (PYTHON26_OR_OLDER and gateway_url.scheme not in ['http', 'https']):
         gateway = 'http://{0}'.format(gateway)
     url = '{0}/metrics/job/{1}'.format(gateway, quote_plus(job))
 
     data = b''
+    headers = [('Content-Type', CONTENT_TYPE_LATEST)]
     if method != 'DELETE':
         data = generate_latest(registry)
+        if compression is not None:
+            if compression != 'gzip':
+                raise ValueError('Unsupported compression: {0}'.format(compression))
+            data = b''.join(compress_chunks([data], 'gzip'))
+            headers.append(('Content-Encoding', 'gzip'))
 
     if grouping_key is None:
         grouping_key = {}
@@ -357,7 +667,7 @@ def _use_gateway(method, gateway, job, registry, grouping_key, timeout, handler)
 
     handler(
         url=url, method=method, timeout=timeout,
-        headers=[('Content-Type', CONTENT_TYPE_LATEST)], data=data,
+        headers=headers, data=data,
     )()
 
 
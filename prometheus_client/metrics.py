@@ -1,3 +1,4 @@
+from bisect import bisect_left
 import sys
 from threading import Lock
 import time
@@ -10,11 +11,17 @@ from .metrics_core import (
     RESERVED_METRIC_LABEL_NAME_RE,
 )
 from .registry import REGISTRY
-from .utils import floatToGoString, INF
+from .utils import _numpy, floatToGoString, INF
 
 if sys.version_info > (3,):
     unicode = str
 
+# Label values of these types are used as they are, without conversion.
+_STRING_TYPES = frozenset([str, unicode])
+
+# Batches at least this large are binned with NumPy, when it's installed.
+_NUMPY_BATCH_SIZE = 64
+
 
 def _build_full_name(metric_type, name, namespace, subsystem, unit):
     full_name = ''
@@ -69,6 +76,14 @@ class MetricWrapperBase(object):
             metric.add_sample(self._name + suffix, labels, value, timestamp=timestamp)
         return [metric]
 
+    def collect_names(self, names):
+        """Collect only the samples with the given names."""
+        metric = self._get_metric()
+        for suffix, labels, value, timestamp in self._samples():
+            if self._name + suffix in names:
+                metric.add_sample(self._name + suffix, labels, value, timestamp=timestamp)
+        return [metric] if metric.samples else []
+
     def __init__(self,
                  name,
                  documentation,
@@ -122,6 +137,13 @@ class MetricWrapperBase(object):
             c.labels(method='get', endpoint='/').inc()
             c.labels(method='post', endpoint='/submit').inc()
 
+        The child returned is a handle bound to its labelset, which can be kept
+        and used directly to skip the lookup on hot paths, as long as the
+        labelset isn't removed in the meantime:
+
+            GET_ROOT = c.labels('get', '/')
+            GET_ROOT.inc()
+
         See the best practices on [naming](http://prometheus.io/docs/practices/naming/)
         and [labels](http://prometheus.io/docs/practices/instrumentation/#use-labels).
         """
@@ -138,13 +160,24 @@ class MetricWrapperBase(object):
             raise ValueError("Can't pass both *args and **kwargs")
 
         if labelkwargs:
-            if sorted(labelkwargs) != sorted(self._labelnames):
+            if len(labelkwargs) != len(self._labelnames):
                 raise ValueError('Incorrect label names')
-            labelvalues = tuple(unicode(labelkwargs[l]) for l in self._labelnames)
-        else:
-            if len(labelvalues) != len(self._labelnames):
-                raise ValueError('Incorrect label count')
-            labelvalues = tuple(unicode(l) for l in labelvalues)
+            try:
+                labelvalues = tuple([labelkwargs[l] for l in self._labelnames])
+            except KeyError:
+                raise ValueError('Incorrect label names')
+        elif len(labelvalues) != len(self._labelnames):
+            raise ValueError('Incorrect label count')
+        # Children are keyed by unicode label values, which the values passed
+        # usually already are, so look them up as they are first. Only plain
+        # strings are, as e.g. a str subclass may convert to something else.
+        # Looking up without the lock is safe, as children are only ever
+        # added under it.
+        if all(type(l) in _STRING_TYPES for l in labelvalues):
+            metric = self._metrics.get(labelvalues)
+            if metric is not None:
+                return metric
+        labelvalues = tuple(unicode(l) for l in labelvalues)
         with self._lock:
             if labelvalues not in self._metrics:
                 self._metrics[labelvalues] = self.__class__(
@@ -239,6 +272,26 @@ class Counter(MetricWrapperBase):
             raise ValueError('Counters can only be incremented by non-negative amounts.')
         self._value.inc(amount)
 
+    def inc_many(self, increments):
+        """Increment children of a labelled counter in one go.
+
+        increments is a mapping or iterable of (labelvalues, amount) pairs,
+        labelvalues being a tuple as passed to labels(). Amounts for the same
+        labels are added up first, so each child is incremented once:
+
+            c = Counter('my_tasks_total', 'Tasks run', ['queue'])
+            c.inc_many([(('default',), 1), (('urgent',), 1), (('default',), 2)])
+        """
+        if hasattr(increments, 'items'):
+            increments = increments.items()
+        totals = {}
+        for labelvalues, amount in increments:
+            if amount < 0:
+                raise ValueError('Counters can only be incremented by non-negative amounts.')
+            totals[labelvalues] = totals.get(labelvalues, 0) + amount
+        for labelvalues, amount in totals.items():
+            self.labels(*labelvalues)._value.inc(amount)
+
     def count_exceptions(self, exception=Exception):
         """Count exceptions in a block of code or function.
 
@@ -424,15 +477,31 @@ class Summary(MetricWrapperBase):
     _reserved_labelnames = ['quantile']
 
     def _metric_init(self):
+        # The count and sum share a lock, so an observation takes it once.
+        lock = Lock()
         self._count = values.ValueClass(self._type, self._name, self._name + '_count', self._labelnames,
-                                        self._labelvalues)
-        self._sum = values.ValueClass(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues)
+                                        self._labelvalues, lock=lock)
+        self._sum = values.ValueClass(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues,
+                                      lock=lock)
         self._created = time.time()
 
     def observe(self, amount):
         """Observe the given amount."""
-        self._count.inc(1)
-        self._sum.inc(amount)
+        self._count.inc_all(((self._count, 1), (self._sum, amount)))
+
+    def observe_many(self, amounts):
+        """Observe each of the given amounts, updating the summary once.
+
+        amounts may be any iterable of numbers, including a NumPy array.
+        """
+        numpy = _numpy()
+        if numpy is not None and isinstance(amounts, numpy.ndarray):
+            count, total = amounts.size, float(amounts.sum())
+        else:
+            amounts = list(amounts)
+            count, total = len(amounts), sum(amounts)
+        if count:
+            self._count.inc_all(((self._count, count), (self._sum, total)))
 
     def time(self):
         """Time a block of code or function, and observe the duration in seconds.
@@ -527,23 +596,65 @@ class Histogram(MetricWrapperBase):
         self._buckets = []
         self._created = time.time()
         bucket_labelnames = self._labelnames + ('le',)
-        self._sum = values.ValueClass(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues)
+        # The sum and buckets share a lock, so an observation takes it once.
+        lock = Lock()
+        self._sum = values.ValueClass(self._type, self._name, self._name + '_sum', self._labelnames, self._labelvalues,
+                                      lock=lock)
         for b in self._upper_bounds:
             self._buckets.append(values.ValueClass(
                 self._type,
                 self._name,
                 self._name + '_bucket',
                 bucket_labelnames,
-                self._labelvalues + (floatToGoString(b),))
+                self._labelvalues + (floatToGoString(b),),
+                lock=lock)
             )
 
     def observe(self, amount):
         """Observe the given amount."""
-        self._sum.inc(amount)
-        for i, bound in enumerate(self._upper_bounds):
-            if amount <= bound:
-                self._buckets[i].inc(1)
-                break
+        i = bisect_left(self._upper_bounds, amount)
+        # Checking the bound as well leaves NaN out of all buckets.
+        if amount <= self._upper_bounds[i]:
+            self._sum.inc_all(((self._sum, amount), (self._buckets[i], 1)))
+        else:
+            self._sum.inc(amount)
+
+    def observe_many(self, amounts):
+        """Observe each of the given amounts, updating the histogram once.
+
+        The amounts are binned first, and the sum and every bucket that got
+        observations are then incremented under a single lock acquisition.
+        amounts may be any iterable of numbers; large batches and NumPy arrays
+        are binned with NumPy when it's installed.
+        """
+        numpy = _numpy()
+        if numpy is not None and not isinstance(amounts, numpy.ndarray):
+            amounts = list(amounts)
+            if len(amounts) >= _NUMPY_BATCH_SIZE:
+                amounts = numpy.asarray(amounts, dtype=numpy.float64)
+        if numpy is not None and isinstance(amounts, numpy.ndarray):
+            if not amounts.size:
+                return
+            total = float(amounts.sum())
+            # NaNs sort after every bound, so land in the last bin, past the buckets.
+            indexes = numpy.searchsorted(self._upper_bounds, amounts.ravel(), side='left')
+            counts = numpy.bincount(indexes, minlength=len(self._buckets) + 1).tolist()
+        else:
+            amounts = list(amounts)
+            if not amounts:
+                return
+            total = sum(amounts)
+            counts = [0] * len(self._buckets)
+            upper_bounds = self._upper_bounds
+            for amount in amounts:
+                i = bisect_left(upper_bounds, amount)
+                if amount <= upper_bounds[i]:
+                    counts[i] += 1
+        updates = [(self._sum, total)]
+        for bucket, count in zip(self._buckets, counts):
+            if count:
+                updates.append((bucket, count))
+        self._sum.inc_all(updates)
 
     def time(self):
         """Time a block of code or function, and observe the duration in seconds.
@@ -0,0 +1,285 @@
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+import mmap
+import os
+import random
+import struct
+
+from .mmap_dict import (
+    _encode_entry, _from_timestamp_float, _pack_integer,
+    _pack_value_timestamp, _read_entries, _to_timestamp_float,
+    _unpack_integer, _value_timestamp, ValueLayout,
+)
+
+ARENA_FILENAME = 'arena.mmap'
+"""Name of the arena file within the multiprocess directory"""
+
+_INITIAL_ARENA_SIZE = 1 << 22
+_SEGMENT_SIZE = 1 << 16
+_HEADER_SIZE = 8
+_SEGMENT_HEADER_SIZE = 56
+_PREFIX_SIZE = 32
+_segment_header = struct.Struct(b'iiiiii')
+
+_FREE = 0
+_IN_USE = 1
+# No longer read, but not reused until freed, as readers may still be
+# reading it.
+_RETIRED = 2
+
+
+class MmapedArena(object):
+    """Segments of values of any number of processes, in one mmapped file.
+
+    This is an alternative to having a MmapedDict per process and file
+    prefix: each process gets segments of a single shared file, allocated
+    under an flock, so readers only open and map one file.
+
+    The file starts with a 4 byte int, the offset at which the last segment
+    ends, and 4 bytes of padding. Segments follow back to back, each starting
+    with a header of 4 byte ints: the size of the segment, its state (free or
+    in use), the pid owning it, how much of it is used, a nonce chosen when
+    it was allocated, and the length of the file prefix ('counter',
+    'gauge_livesum', ...) which follows, padded to 32 bytes. The rest of the
+    segment holds entries in the same format as a MmapedDict.
+
+    Segments are never shared between processes; a segment which is freed
+    once its process is dead and archived may be reused by another process.
+    Freeing must exclude readers, so segments which can't be freed right
+    away are retired instead, which hides them from new readers, and freed
+    later. The flock only serializes allocation between processes, not
+    threads.
+    """
+
+    def __init__(self, filename, read_mode=False):
+        self._f = open(filename, 'rb' if read_mode else 'a+b')
+        self._fname = filename
+        self._read_mode = read_mode
+        self._m = None
+        if not read_mode:
+            with self._locked():
+                if self._capacity == 0:
+                    self._f.truncate(_INITIAL_ARENA_SIZE)
+                    self._remap()
+                if self._end == 0:
+                    _pack_integer(self._m, 0, _HEADER_SIZE)
+        else:
+            self._remap()
+
+    @property
+    def _capacity(self):
+        return os.fstat(self._f.fileno()).st_size
+
+    @property
+    def _end(self):
+        if self._m is None:
+            return 0
+        return min(_unpack_integer(self._m, 0)[0], len(self._m))
+
+    @property
+    def cache_key(self):
+        """Identifies the arena file to readers caching its contents."""
+        st = os.fstat(self._f.fileno())
+        return st.st_dev, st.st_ino
+
+    def _remap(self):
+        capacity = self._capacity
+        if capacity and (self._m is None or len(self._m) != capacity):
+            # Previous maps are left to be garbage collected, as values of
+            # other threads may still hold on to them.
+            self._m = mmap.mmap(self._f.fileno(), capacity,
+                                access=mmap.ACCESS_READ if self._read_mode else mmap.ACCESS_WRITE)
+
+    @contextmanager
+    def _locked(self):
+        flock(self._f, LOCK_EX)
+        try:
+            # Another process may have grown the file.
+            self._remap()
+            yield
+        finally:
+            flock(self._f, LOCK_UN)
+
+    def _headers(self):
+        """Yield (base, size, state, pid, prefix) of every segment."""
+        data = self._m
+        end = self._end
+        base = _HEADER_SIZE
+        while base + _SEGMENT_HEADER_SIZE <= end:
+            size, state, pid, _, _, prefix_len = _segment_header.unpack_from(data, base)
+            if size < _SEGMENT_HEADER_SIZE or prefix_len > _PREFIX_SIZE:
+                raise RuntimeError('Invalid segment detected, %s is corrupted.' % self._fname)
+            if base + size > end:
+                # Allocated after this arena was mapped by a reader.
+                break
+            prefix = data[base + 24:base + 24 + prefix_len].decode('utf-8')
+            yield base, size, state, pid, prefix
+            base += size
+
+    def allocate(self, prefix, pid, min_size=_SEGMENT_SIZE):
+        """Allocate a segment for the given file prefix and pid.
+
+        Returns the base offset of the segment.
+        """
+        encoded = prefix.encode('utf-8')
+        if len(encoded) > _PREFIX_SIZE:
+            raise ValueError('Prefix too long for arena: ' + prefix)
+        size = max(min_size, _SEGMENT_SIZE)
+        size += -size % 8
+        with self._locked():
+            for base, seg_size, state, _, _ in self._headers():
+                if state == _FREE and seg_size >= size:
+                    size = seg_size
+                    break
+            else:
+                base = self._end
+                capacity = self._capacity
+                while base + size > capacity:
+                    capacity *= 2
+                if capacity != self._capacity:
+                    self._f.truncate(capacity)
+                    self._remap()
+            data = self._m
+            data[base + 24:base + _SEGMENT_HEADER_SIZE] = encoded.ljust(_PREFIX_SIZE, b'\0')
+            data[base:base + 24] = _segment_header.pack(
+                size, _FREE, pid, _SEGMENT_HEADER_SIZE, random.randint(1, 0x7fffffff), len(encoded))
+            # Only mark it in use once the rest of the header is in place.
+            _pack_integer(data, base + 4, _IN_USE)
+            if base + size > self._end:
+                _pack_integer(data, 0, base + size)
+        return base
+
+    def free(self, bases):
+        """Mark the segments at the given offsets as free for reuse."""
+        with self._locked():
+            for base in bases:
+                _pack_integer(self._m, base + 4, _FREE)
+
+    def retire(self, bases):
+        """Mark the segments at the given offsets as no longer in use.
+
+        They're skipped by readers opening them from then on, but not reused
+        until freed by free_retired().
+        """
+        with self._locked():
+            for base in bases:
+                _pack_integer(self._m, base + 4, _RETIRED)
+
+    def free_retired(self):
+        """Mark all retired segments as free for reuse."""
+        with self._locked():
+            for base, _, state, _, _ in self._headers():
+                if state == _RETIRED:
+                    _pack_integer(self._m, base + 4, _FREE)
+
+    def segments(self, pids=None, prefixes=None):
+        """Yield an ArenaSegment per segment in use.
+
+        Optionally only those of the given pids and file prefixes.
+        """
+        cache_key = self.cache_key
+        for base, size, state, pid, prefix in self._headers():
+            if state != _IN_USE:
+                continue
+            if (pids is None or pid in pids) and (prefixes is None or prefix in prefixes):
+                yield ArenaSegment(self, cache_key + (base,), base, size, pid, prefix)
+
+    def close(self):
+        if self._f:
+            if self._m is not None:
+                self._m.close()
+                self._m = None
+            self._f.close()
+            self._f = None
+
+
+class ArenaSegment(object):
+    """Read access to one segment of a MmapedArena, like a MmapedDict's."""
+
+    def __init__(self, arena, cache_key, base, size, pid, prefix):
+        self._arena = arena
+        self.cache_key = cache_key
+        self._base = base
+        self._size = size
+        self.pid = pid
+        self.prefix = prefix
+        self._m = arena._m
+        self.nonce = _unpack_integer(self._m, base + 16)[0]
+        used = _unpack_integer(self._m, base + 12)[0]
+        if used < _SEGMENT_HEADER_SIZE or used > size:
+            raise RuntimeError('Invalid segment detected, %s is corrupted.' % arena._fname)
+        self._used = base + used
+
+    def _read_all_values(self, start=0):
+        """Yield (key, value, timestamp, pos). No locking is performed."""
+        start = max(start, self._base + _SEGMENT_HEADER_SIZE)
+        return _read_entries(self._m, start, self._used, self._arena._fname)
+
+    def read_all_values(self):
+        """Yield (key, value, timestamp). No locking is performed."""
+        for k, v, ts, _ in self._read_all_values():
+            yield k, v, ts
+
+    def read_values(self, positions):
+        """Return (values, timestamps) of the slots at the given positions."""
+        if not isinstance(positions, ValueLayout):
+            positions = ValueLayout(positions)
+        return positions.read(self._m)
+
+    def close(self):
+        """Segments are closed along with their arena."""
+
+
+class ArenaDict(object):
+    """A dict of doubles for one process and file prefix, within an arena.
+
+    Provides the same interface as a MmapedDict for writers, allocating
+    another segment whenever the current one is full.
+
+    Not thread safe.
+    """
+
+    def __init__(self, arena, prefix, pid):
+        self._arena = arena
+        self._prefix = prefix
+        self._pid = int(pid)
+        self._positions = {}
+        self._base = None
+        self._used = self._end = 0
+
+    def _init_value(self, key):
+        """Initialize a value. Lock must be held by caller."""
+        value = _encode_entry(key)
+        if self._base is None or self._used + len(value) > self._end:
+            size = _SEGMENT_HEADER_SIZE + len(value)
+            self._base = self._arena.allocate(self._prefix, self._pid, size)
+            self._used = self._base + _SEGMENT_HEADER_SIZE
+            self._end = self._base + _unpack_integer(self._arena._m, self._base)[0]
+        data = self._arena._m
+        data[self._used:self._used + len(value)] = value
+
+        # Update how much of the segment we've used.
+        self._used += len(value)
+        _pack_integer(data, self._base + 12, self._used - self._base)
+        self._positions[key] = self._used - _value_timestamp.size
+
+    def read_value_timestamp(self, key):
+        if key not in self._positions:
+            self._init_value(key)
+        pos = self._positions[key]
+        # We assume that reading from an 8 byte aligned value is atomic
+        val, ts = _value_timestamp.unpack_from(self._arena._m, pos)
+        return val, _from_timestamp_float(ts)
+
+    def read_value(self, key):
+        return self.read_value_timestamp(key)[0]
+
+    def write_value(self, key, value, timestamp=None):
+        if key not in self._positions:
+            self._init_value(key)
+        pos = self._positions[key]
+        # We assume that writing to an 8 byte aligned value is atomic
+        _pack_value_timestamp(self._arena._m, pos, value, _to_timestamp_float(timestamp))
+
+    def close(self):
+        """The segments stay allocated until the process is archived."""
@@ -1,13 +1,29 @@
 import json
 import mmap
 import os
+import random
 import struct
+import sys
+
+from .utils import _numpy
 
 _INITIAL_MMAP_SIZE = 1 << 20
 _pack_integer_func = struct.Struct(b'i').pack
 _value_timestamp = struct.Struct(b'dd')
 _unpack_integer = struct.Struct(b'i').unpack_from
 
+# Keys are either legacy JSON arrays, or this marker followed by the '\0'
+# separated metric name, sample name and sorted label name/value pairs.
+_KEY_SEPARATOR = u'\x00'
+_KEY_V1 = _KEY_SEPARATOR + u'1' + _KEY_SEPARATOR
+
+if sys.version_info > (3,):
+    _intern = sys.intern
+else:
+    # intern() only takes byte strings on Python 2.
+    def _intern(s):
+        return s
+
 
 # struct.pack_into has atomicity issues because it will temporarily write 0 into
 # the mmap, resulting in false reads to 0 when experiencing a lot of writes.
@@ -20,11 +36,42 @@ def _pack_integer(data, pos, value):
     data[pos:pos + 4] = _pack_integer_func(value)
 
 
+def _encode_entry(key):
+    """Encode a new entry for key, with a zero value and timestamp."""
+    encoded = key.encode('utf-8')
+    # Pad to be 8-byte aligned.
+    padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
+    return struct.pack('i{0}sdd'.format(len(padded)).encode(), len(encoded), padded, 0.0, 0.0)
+
+
+def _read_entries(data, pos, used, fname):
+    """Yield (key, value, timestamp, pos) of the entries from pos to used."""
+    # cache variables to local ones and prevent attributes lookup
+    # on every loop iteration
+    unpack_from = struct.unpack_from
+
+    while pos < used:
+        encoded_len = _unpack_integer(data, pos)[0]
+        # check we are not reading beyond bounds
+        if encoded_len + pos > used:
+            msg = 'Read beyond file size detected, %s is corrupted.'
+            raise RuntimeError(msg % fname)
+        pos += 4
+        encoded = unpack_from(('%ss' % encoded_len).encode(), data, pos)[0]
+        padded_len = encoded_len + (8 - (encoded_len + 4) % 8)
+        pos += padded_len
+        value, timestamp = _value_timestamp.unpack_from(data, pos)
+        yield encoded.decode('utf-8'), value, _from_timestamp_float(timestamp), pos
+        pos += _value_timestamp.size
+
+
 class MmapedDict(object):
     """A dict of doubles, backed by an mmapped file.
 
     The file starts with a 4 byte int, indicating how much of it is used.
-    Then 4 bytes of padding.
+    Then a 4 byte int nonce, chosen randomly when the file is created, which
+    lets readers tell a file apart from an earlier one that had the same path
+    or inode (older files have 0 here).
     There's then a number of entries, consisting of a 4 byte int which is the
     size of the next field, a utf-8 encoded string key, padding to a 8 byte
     alignment, a 8 byte float which is the value and then an 8 byte timestamp (seconds).
@@ -46,6 +93,7 @@ class MmapedDict(object):
         if self._used == 0:
             self._used = 8
             _pack_integer(self._m, 0, self._used)
+            _pack_integer(self._m, 4, random.randint(1, 0x7fffffff))
         else:
             if not read_mode:
                 for key, _, _, pos in self._read_all_values():
@@ -53,10 +101,7 @@ class MmapedDict(object):
 
     def _init_value(self, key):
         """Initialize a value. Lock must be held by caller."""
-        encoded = key.encode('utf-8')
-        # Pad to be 8-byte aligned.
-        padded = encoded + (b' ' * (8 - (len(encoded) + 4) % 8))
-        value = struct.pack('i{0}sdd'.format(len(padded)).encode(), len(encoded), padded, 0.0, 0.0)
+        value = _encode_entry(key)
         while self._used + len(value) > self._capacity:
             self._capacity *= 2
             self._f.truncate(self._capacity)
@@ -68,36 +113,33 @@ class MmapedDict(object):
         _pack_integer(self._m, 0, self._used)
         self._positions[key] = self._used - _value_timestamp.size
 
-    def _read_all_values(self):
-        """Yield (key, value, timestamp, pos). No locking is performed."""
-
-        pos = 8
-
-        # cache variables to local ones and prevent attributes lookup
-        # on every loop iteration
-        used = self._used
-        data = self._m
-        unpack_from = struct.unpack_from
-
-        while pos < used:
-            encoded_len = _unpack_integer(data, pos)[0]
-            # check we are not reading beyond bounds
-            if encoded_len + pos > used:
-                msg = 'Read beyond file size detected, %s is corrupted.'
-                raise RuntimeError(msg % self._fname)
-            pos += 4
-            encoded = unpack_from(('%ss' % encoded_len).encode(), data, pos)[0]
-            padded_len = encoded_len + (8 - (encoded_len + 4) % 8)
-            pos += padded_len
-            value, timestamp = _value_timestamp.unpack_from(data, pos)
-            yield encoded.decode('utf-8'), value, _from_timestamp_float(timestamp), pos
-            pos += _value_timestamp.size
+    @property
+    def cache_key(self):
+        """Identifies the file to readers caching its contents."""
+        st = os.fstat(self._f.fileno())
+        return st.st_dev, st.st_ino
+
+    @property
+    def nonce(self):
+        return _unpack_integer(self._m, 4)[0]
+
+    def _read_all_values(self, start=8):
+        """Yield (key, value, timestamp, pos). No locking is performed.
+
+        Entries are append-only, so a reader that has already seen the file
+        up to some previous `used` offset can pass it as `start` to only read
+        the entries added since.
+        """
+        return _read_entries(self._m, max(start, 8), self._used, self._fname)
 
     def read_all_values(self):
         """Yield (key, value, pos). No locking is performed."""
         for k, v, ts, _ in self._read_all_values():
             yield k, v, ts
 
+    def __contains__(self, key):
+        return key in self._positions
+
     def read_value_timestamp(self, key):
         if key not in self._positions:
             self._init_value(key)
@@ -109,6 +151,17 @@ class MmapedDict(object):
     def read_value(self, key):
         return self.read_value_timestamp(key)[0]
 
+    def read_values(self, positions):
+        """Return (values, timestamps) of the slots at the given positions.
+
+        `positions` is a ValueLayout, or a list of positions as returned by
+        _read_all_values. Timestamps are returned as raw floats, inf meaning
+        no timestamp. No locking is performed.
+        """
+        if not isinstance(positions, ValueLayout):
+            positions = ValueLayout(positions)
+        return positions.read(self._m)
+
     def write_value(self, key, value, timestamp=None):
         if key not in self._positions:
             self._init_value(key)
@@ -116,6 +169,11 @@ class MmapedDict(object):
         # We assume that writing to an 8 byte aligned value is atomic
         _pack_value_timestamp(self._m, pos, value, _to_timestamp_float(timestamp))
 
+    def sync(self):
+        """Write the values through to disk."""
+        self._m.flush()
+        os.fsync(self._f.fileno())
+
     def close(self):
         if self._f:
             self._m.close()
@@ -124,11 +182,72 @@ class MmapedDict(object):
             self._f = None
 
 
+class ValueLayout(object):
+    """The positions of a set of value slots, prepared for bulk reads.
+
+    Reading through a layout fetches every value and timestamp in one call:
+    a NumPy gather when NumPy is installed, otherwise a single precompiled
+    struct which skips over the keys in between. Positions must be ascending,
+    as they are when read from a file, and building the layout is far more
+    expensive than reading with it, so it is meant to be kept around for as
+    long as the set of positions doesn't change.
+    """
+
+    def __init__(self, positions):
+        self.positions = positions = list(positions)
+        self._end = positions[-1] + _value_timestamp.size if positions else 0
+        self._index = self._struct = None
+        self._numpy = numpy = _numpy()
+        if numpy is not None:
+            self._index = numpy.array(positions, dtype=numpy.intp) // 8
+        else:
+            fmt = ['=']
+            end = 0
+            for pos in positions:
+                fmt.append('{0}xdd'.format(pos - end))
+                end = pos + _value_timestamp.size
+            self._struct = struct.Struct(''.join(fmt).encode())
+
+    def __len__(self):
+        return len(self.positions)
+
+    def read(self, data):
+        """Return (values, timestamps) read from the mmap `data`."""
+        if not self.positions:
+            return (), ()
+        if self._index is not None:
+            numpy = self._numpy
+            doubles = numpy.frombuffer(data, dtype=numpy.float64, count=self._end // 8)
+            try:
+                # Fancy indexing copies, so nothing keeps the mmap exported.
+                return doubles[self._index], doubles[self._index + 1]
+            finally:
+                del doubles
+        unpacked = self._struct.unpack_from(data, 0)
+        return unpacked[0::2], unpacked[1::2]
+
+
 def mmap_key(metric_name, name, labelnames, labelvalues):
     """Format a key for use in the mmap file."""
     # ensure labels are in consistent order for identity
-    labels = dict(zip(labelnames, labelvalues))
-    return json.dumps([metric_name, name, labels], sort_keys=True)
+    labels = sorted(zip(labelnames, labelvalues))
+    fields = [metric_name, name]
+    for l in labels:
+        fields.extend(l)
+    if any(_KEY_SEPARATOR in f for f in fields):
+        # Can't be represented in the compact format, which is fine as
+        # readers still understand the legacy one.
+        return json.dumps([metric_name, name, dict(labels)], sort_keys=True)
+    return _KEY_V1 + _KEY_SEPARATOR.join(fields)
+
+
+def decode_key(key):
+    """Parse a key written by mmap_key into (metric_name, name, labels)."""
+    if not key.startswith(_KEY_V1):
+        return json.loads(key)
+    fields = key[len(_KEY_V1):].split(_KEY_SEPARATOR)
+    labels = dict(zip(fields[2::2], fields[3::2]))
+    return _intern(fields[0]), _intern(fields[1]), labels
 
 
 def _from_timestamp_float(timestamp):
@@ -2,29 +2,66 @@
 
 from __future__ import unicode_literals
 
+import atexit
 from collections import defaultdict
 from contextlib import contextmanager
 import errno
 from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
 import glob
-import json
 import logging
+from multiprocessing import Pool
 import os
 import re
 import shutil
-import tempfile
-from threading import RLock
+from threading import Lock, RLock
 import time
 
-from .metrics import Counter, Gauge, Histogram
+from .metrics import Counter, Gauge, Histogram, Summary
 from .metrics_core import GaugeMetricFamily, Metric
-from .mmap_dict import mmap_key, MmapedDict
+from .mmap_arena import ARENA_FILENAME, MmapedArena
+from .mmap_dict import decode_key, mmap_key, MmapedDict, ValueLayout
+from .pid_index import PidIndex
 from .samples import Sample
-from .utils import floatToGoString
+from .utils import _numpy, floatToGoString, INF
 from .vendor import six
 
 PROMETHEUS_MULTIPROC_DIR = "prometheus_multiproc_dir"
 _db_pattern = re.compile(r"(\w+)_(\d+)\.db")
+_ADDITIVE_TYPES = frozenset((Counter._type, Histogram._type, Summary._type))
+# Files of dead processes which are merged into the archive
+_ARCHIVED_PREFIXES = (
+    Counter._type,
+    "{}_{}".format(Gauge._type, Gauge.LATEST),
+    "{}_{}".format(Gauge._type, Gauge.MAX),
+    "{}_{}".format(Gauge._type, Gauge.MIN),
+    Histogram._type,
+)
+_LIVE_PREFIXES = (
+    "{}_{}".format(Gauge._type, Gauge.LIVESUM),
+    "{}_{}".format(Gauge._type, Gauge.LIVEALL),
+)
+# How the values of each series are folded for gauges not kept per process
+_GAUGE_FOLDS = {
+    Gauge.MAX: lambda current, value: value if value > current else current,
+    Gauge.MIN: lambda current, value: value if value < current else current,
+    Gauge.LIVESUM: lambda current, value: current + value,
+}
+# Values of additive series buffered before adding them to the totals
+_SUMS_BUFFER = 1 << 16
+# Archive files of dead processes, by type and multiprocess mode
+_ARCHIVE_FILENAMES = {
+    (Histogram._type, None): "histogram.db",
+    (Counter._type, None): "counter.db",
+    (Gauge._type, Gauge.LATEST): "gauge_{}.db".format(Gauge.LATEST),
+    (Gauge._type, Gauge.MAX): "gauge_{}.db".format(Gauge.MAX),
+    (Gauge._type, Gauge.MIN): "gauge_{}.db".format(Gauge.MIN),
+}
+# Link to the directory of the current archive generation
+ARCHIVE_LINK = "archive"
+# Lists the pids merged into an archive generation
+_ARCHIVED_PIDS = "archived_pids"
+# Suffixes of sample names to the name of their metric
+_SAMPLE_SUFFIXES = ('_total', '_created', '_bucket', '_count', '_sum', '_gcount', '_gsum', '_info')
 
 
 class MetricsCache(object):
@@ -60,6 +97,171 @@ class MetricsCache(object):
 _metrics_cache = MetricsCache()
 
 
+class _FileState(object):
+    """What a previous pass learned about one .db file."""
+
+    __slots__ = ('identity', 'used', 'keys', 'positions', 'layout', 'ids')
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.used = 0
+        # (metric_name, name, labels_key) and position of each entry so far
+        self.keys = []
+        self.positions = []
+        # Derived from the above, rebuilt when entries are appended
+        self.layout = None
+        self.ids = None
+
+
+class FileCache(object):
+    """
+    Remembers the decoded entries of each .db file between merges.
+
+    Entries are never rewritten once appended to a file, only their value and
+    timestamp slots change. Files (and arena segments) are keyed by inode, and for each one the
+    decoded (metric_name, name, labels) of every entry is kept along with
+    its offset, so later passes only parse the range past the last seen
+    `used` offset and otherwise just read the value slots in bulk. A file
+    that was replaced (different nonce or pid, or a smaller `used` offset)
+    is parsed from scratch.
+
+    Not thread safe; each caller that merges repeatedly should own one.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._seen = set()
+        # Index of every series seen in additive files, for summing in bulk
+        self._series = {}
+        self._series_keys = []
+
+    def _state(self, d, pid):
+        cache_key = d.cache_key
+        identity = (d.nonce, pid)
+        state = self._files.get(cache_key)
+        if state is None or state.identity != identity or state.used > d._used:
+            state = self._files[cache_key] = _FileState(identity)
+        self._seen.add(cache_key)
+
+        if d._used > state.used:
+            for key, _, _, pos in d._read_all_values(start=state.used):
+                state.keys.append(_decode_key(key, pid))
+                state.positions.append(pos)
+            state.used = d._used
+            state.layout = state.ids = None
+        if state.layout is None:
+            state.layout = ValueLayout(state.positions)
+        return state
+
+    def read(self, d, pid):
+        """Yield (metric_name, name, labels_key, value, timestamp) for `d`."""
+        state = self._state(d, pid)
+        values, timestamps = d.read_values(state.layout)
+        for key, value, timestamp in zip(state.keys, values, timestamps):
+            metric_name, name, labels_key = key
+            yield metric_name, name, labels_key, float(value), None if timestamp == INF else float(timestamp)
+
+    def add_to(self, sums, d, typ, pid):
+        """Add the values of `d` to the _Sums of the current pass."""
+        state = self._state(d, pid)
+        if state.ids is None:
+            series = self._series
+            ids = []
+            for key in state.keys:
+                key = (typ,) + key
+                i = series.get(key)
+                if i is None:
+                    i = series[key] = len(self._series_keys)
+                    self._series_keys.append(key)
+                ids.append(i)
+            numpy = _numpy()
+            state.ids = numpy.array(ids, dtype=numpy.intp) if numpy is not None else ids
+        values, _ = d.read_values(state.layout)
+        sums.add(state.ids, values)
+
+    def sums(self):
+        """Start summing values for a pass."""
+        return _Sums(self._series_keys)
+
+    def prune(self):
+        """Forget the files which were not read since the last prune."""
+        dropped = set(self._files) - self._seen
+        for cache_key in dropped:
+            del self._files[cache_key]
+        self._seen = set()
+        if dropped:
+            # Series of removed files may be gone for good, so start over
+            # rather than letting the index grow with churn.
+            self._series = {}
+            self._series_keys = []
+            for state in self._files.values():
+                state.ids = None
+
+
+class _Sums(object):
+    """Per-series totals of the additive (counter, histogram, summary) files.
+
+    Values are gathered per file and summed in bulk, with NumPy when it is
+    installed, instead of building a sample per file and series. At most
+    _SUMS_BUFFER values are held before being added to the totals, so
+    memory is bounded by the number of series rather than files.
+    """
+
+    def __init__(self, series_keys):
+        self._series_keys = series_keys
+        self._ids = []
+        self._values = []
+        self._buffered = 0
+        self._numpy = _numpy()
+        self._totals = None if self._numpy is not None else {}
+        self._present = None
+
+    def add(self, ids, values):
+        if self._numpy is None:
+            totals = self._totals
+            for i, value in zip(ids, values):
+                totals[i] = totals.get(i, 0.0) + value
+            return
+        self._ids.append(ids)
+        self._values.append(values)
+        self._buffered += len(ids)
+        if self._buffered >= _SUMS_BUFFER:
+            self._flush()
+
+    def _flush(self):
+        n = len(self._series_keys)
+        numpy = self._numpy
+        ids = numpy.concatenate(self._ids)
+        totals = numpy.bincount(ids, weights=numpy.concatenate(self._values), minlength=n)
+        present = numpy.bincount(ids, minlength=n) > 0
+        if self._totals is not None:
+            # Series may have been added since, which grows the arrays.
+            totals[:len(self._totals)] += self._totals
+            present[:len(self._present)] |= self._present
+        self._totals = totals
+        self._present = present
+        self._ids = []
+        self._values = []
+        self._buffered = 0
+
+    def __iter__(self):
+        """Yield ((typ, metric_name, name, labels_key), total)."""
+        if self._numpy is None:
+            for i, total in six.iteritems(self._totals):
+                yield self._series_keys[i], total
+            return
+        if self._ids:
+            self._flush()
+        if self._totals is None:
+            return
+        totals = self._totals.tolist()
+        for i in self._present.nonzero()[0].tolist():
+            yield self._series_keys[i], totals[i]
+
+
+_archive_file_cache = FileCache()
+
+
 class InMemoryCollector(object):
     """
     A Collector which simply serves metrics collected by the archiver
@@ -76,35 +278,112 @@ class InMemoryCollector(object):
 
 
 class MultiProcessCollector(object):
-    """Collector for files for multi-process mode."""
+    """Collector for files for multi-process mode.
+
+    With a `lock_timeout` (in seconds), a scrape which can't get the lock
+    that long, as the files of dead processes are being archived, gets
+    the metrics of the last scrape which did instead. The collector then
+    also returns prom_client_multiprocess_staleness_seconds, how old the
+    metrics it returned are, or 0 if they're current. Only the first scrape
+    waits for the lock however long it takes.
+    """
 
-    def __init__(self, registry, path=None):
+    def __init__(self, registry, path=None, processes=None, lock_timeout=None):
         if path is None:
             path = os.environ.get('prometheus_multiproc_dir')
         if not path or not os.path.isdir(path):
             raise ValueError('env prometheus_multiproc_dir is not set or not a directory')
         self._path = path
+        # Merge in a pool of that many processes, see merge.
+        self._processes = processes
+        # Scrapes may come in concurrently, but share the decoded keys.
+        self._cache = FileCache()
+        self._cache_lock = Lock()
+        self._lock_timeout = lock_timeout
+        # The metrics of the last full collection, and when it was made.
+        self._last = None
         if registry:
             registry.register(self)
 
 
     def collect(self, blocking=True):
         # blocking=False is used for testing purposes
-        lock_type = LOCK_SH if blocking else LOCK_SH | LOCK_NB
-        with advisory_lock(lock_type):
-            files = glob.glob(os.path.join(self._path, '*.db'))
-            return merge(files, accumulate=True)
+        return self._collect(None, blocking)
 
+    def collect_names(self, names):
+        """Collect only the metrics which may have samples with the given names."""
+        return self._collect(_metric_names(names))
 
-def merge(files, accumulate=True):
+    def _collect(self, metric_names, blocking=True):
+        lock_type = LOCK_SH if blocking else LOCK_SH | LOCK_NB
+        last = self._last
+        timeout = self._lock_timeout if blocking and last is not None else None
+        try:
+            with advisory_lock(lock_type, prom_dir=self._path, timeout=timeout):
+                files = _files_to_merge(self._path)
+                with self._cache_lock:
+                    metrics = merge(files, accumulate=True, cache=self._cache, metric_names=metric_names,
+                                    processes=self._processes)
+        except LockTimeout:
+            # The whole of it, but the registry filters restricted collections.
+            metrics, collected_at = last
+            return metrics + [self._staleness(time.time() - collected_at)]
+        if self._lock_timeout is None:
+            return metrics
+        metrics = list(metrics)
+        if metric_names is None:
+            self._last = (metrics, time.time())
+        return metrics + [self._staleness(0)]
+
+    @staticmethod
+    def _staleness(seconds):
+        return GaugeMetricFamily(
+            'prom_client_multiprocess_staleness_seconds',
+            'Age of the multiprocess metrics returned, when the lock could not be acquired in time',
+            value=seconds)
+
+
+def _files_to_merge(path):
+    """Return the files of processes and the archive in path to merge."""
+    files = glob.glob(os.path.join(path, '*.db'))
+    if os.path.isdir(os.path.join(path, ARCHIVE_LINK)):
+        # Archive files an older version left behind are merged into the
+        # current generation already.
+        legacy = set(os.path.join(path, f) for f in _ARCHIVE_FILENAMES.values())
+        files = [f for f in files if f not in legacy]
+        files.extend(f for f in _get_archive_paths(path).values() if os.path.exists(f))
+    files.append(os.path.join(path, ARENA_FILENAME))
+    return files
+
+
+def _metric_names(names):
+    """Return the names of the metrics which may have samples with the given names."""
+    metric_names = set(names)
+    for name in names:
+        for suffix in _SAMPLE_SUFFIXES:
+            if name.endswith(suffix):
+                metric_names.add(name[:-len(suffix)])
+    return metric_names
+
+
+def merge(files, accumulate=True, cache=None, metric_names=None, processes=None):
     """Merge metrics from given mmap files.
 
     By default, histograms are accumulated, as per prometheus wire format.
     But if writing the merged data back to mmap files, use
     accumulate=False to avoid compound accumulation.
+
+    `cache` is an optional FileCache, letting repeated merges of the same
+    files skip parsing the entries they have already seen.
+
+    `metric_names` optionally restricts the merge to the metrics with those
+    names.
+
+    With `processes` greater than one, the files are loaded in a pool of
+    that many processes, see load_metrics_from_files.
     """
 
-    metrics = load_metrics_from_files(files)
+    metrics = load_metrics_from_files(files, cache=cache, metric_names=metric_names, processes=processes)
 
     for metric in six.itervalues(metrics):
         # Handle the Gauge "latest" multiprocess mode type:
@@ -182,66 +461,352 @@ def merge(files, accumulate=True):
     return metrics.values()
 
 
-def load_metrics_from_files(files):
-    # TODO: read from
-    metrics = {}
-    for f in files:
-        parts = os.path.splitext(os.path.basename(f))[0].split('_')
-        typ = parts[0]
-        multiprocess_mode = parts[1] if typ == Gauge._type else None
-        pid = parts[2] if multiprocess_mode and len(parts) > 2 else None
-        try:
-            d = MmapedDict(f, read_mode=True)
-        except EnvironmentError:
-            # The liveall and livesum gauge metrics
-            # are deleted when the gunicorn/celery worker process dies
-            # (mark_process_dead and, in postal-main, boot.gunicornconf.child_exit).
-            # Since these are deleted without acquiring a lock, they may
-            # not be present in between collecting the metrics files and
-            # merging them, resulting in a FileNotFoundError/IOError.
-            # However, since these gauges only care about live processes,
-            # we wouldn't merge them anyway.
-            #
-            # Additionally, we have a single thread which will collect
-            # metrics files from dead workers, and merge them into a set of
-            # archive files at regular interviews (see
-            # multiprocess_exporter). This operation is protected by a
-            # mutex, ensuring that no collectors are run during cleanup. We
-            # must do so because other metrics are sensitive to partial
-            # collection; prometheus counters cannot be decremented, as
-            # prometheus will assume that, in the time since the last scrape,
-            # the counter reset to 0 and incremented back up to the
-            # collected value, manifesting as a huge rate spike
-            if typ == 'gauge' and parts[1] in (Gauge.LIVESUM, Gauge.LIVEALL):
-                continue
-            raise
+def load_metrics_from_files(files, cache=None, metric_names=None, processes=None):
+    """Load the metrics of the given mmap files.
 
-        for key, value, timestamp in d.read_all_values():
-            metric_name, name, labels = json.loads(key)
-            if pid:
-                labels["pid"] = pid
-            labels_key = tuple(sorted(labels.items()))
+    Samples of counters, histograms and summaries are summed over all files,
+    as merge would anyway, and so are reduced those of gauges in the max,
+    min, livesum and latest modes, without their pid label. The values are
+    folded into one per series as they're read. Other samples are returned
+    per file.
 
+    `metric_names` optionally restricts loading to the metrics with those
+    names.
+
+    With `processes` greater than one, the files (and the pids of arena
+    files) are split between a pool of that many processes, each of which
+    loads its share, and the results are combined. The pool is started on
+    the first such call and reused by later ones. `cache` is not used then,
+    as the processes don't share it.
+    """
+    if processes is not None and processes > 1:
+        shares = _partition(files, processes)
+        if len(shares) > 1:
+            partials = _get_pool(processes).map(_load_share, [(share, metric_names) for share in shares])
+            return _combine(partials)
+    if cache is None:
+        cache = FileCache()
+    sums = cache.sums()
+    metrics = {}
+    # (metric_name, name, labels_key) to [value, timestamp] of folded gauges
+    folded = {}
+    for typ, multiprocess_mode, pid, d in _open_files(files):
+        if typ in _ADDITIVE_TYPES:
+            # These are only ever summed, do so right away.
+            cache.add_to(sums, d, typ, pid)
+            continue
+        reduced = _is_reduced(typ, multiprocess_mode)
+        fold = _GAUGE_FOLDS.get(multiprocess_mode)
+        if reduced:
+            # Reduced over processes, so read without the pid label.
+            pid = None
+        for metric_name, name, labels_key, value, timestamp in cache.read(d, pid):
+            if metric_names is not None and metric_name not in metric_names:
+                continue
             metric = metrics.get(metric_name)
             if metric is None:
                 metric = Metric(metric_name, 'Multiprocess metric', typ)
                 metrics[metric_name] = metric
             if multiprocess_mode:
                 metric._multiprocess_mode = multiprocess_mode
-            metric.add_sample(name, labels_key, value, timestamp=timestamp)
-        d.close()
+            if not reduced:
+                metric.add_sample(name, labels_key, value, timestamp=timestamp)
+                continue
+            _fold_into(folded, (metric_name, name, labels_key), fold, value, timestamp)
+    for (metric_name, name, labels_key), (value, timestamp) in six.iteritems(folded):
+        metrics[metric_name].add_sample(name, labels_key, value, timestamp=timestamp)
+    for (typ, metric_name, name, labels_key), value in sums:
+        if metric_names is not None and metric_name not in metric_names:
+            continue
+        metric = metrics.get(metric_name)
+        if metric is None:
+            metric = Metric(metric_name, 'Multiprocess metric', typ)
+            metrics[metric_name] = metric
+        metric.add_sample(name, labels_key, value)
+    cache.prune()
     return metrics
 
 
+# (pid, processes) to the pool of that many processes started by that pid
+_pools = {}
+_pools_lock = Lock()
+
+
+def _get_pool(processes):
+    """Return the pool of that many processes of this process, starting it if needed."""
+    pid = os.getpid()
+    with _pools_lock:
+        pool = _pools.get((pid, processes))
+        if pool is None:
+            # Pools inherited over a fork belong to the parent.
+            for key in [key for key in _pools if key[0] != pid]:
+                del _pools[key]
+            pool = _pools[(pid, processes)] = Pool(processes)
+        return pool
+
+
+def _close_pools():
+    """Shut down the pools started by this process."""
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [pool for key, pool in _pools.items() if key[0] == pid]
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+        pool.join()
+
+
+atexit.register(_close_pools)
+
+
+def _is_reduced(typ, multiprocess_mode):
+    """Whether series of this type are reduced over processes."""
+    return typ == Gauge._type and (multiprocess_mode in _GAUGE_FOLDS or multiprocess_mode == Gauge.LATEST)
+
+
+def _fold_into(folded, key, fold, value, timestamp):
+    """Fold a value into folded[key], the most recent one if fold is None."""
+    current = folded.get(key)
+    if current is None:
+        folded[key] = [value, timestamp]
+    elif fold is not None:
+        current[0] = fold(current[0], value)
+    elif timestamp is not None and (current[1] is None or timestamp > current[1]):
+        current[:] = [value, timestamp]
+
+
+def _partition(files, n):
+    """Split the files to load into at most n shares of similar size.
+
+    Arena files are split by pid.
+    """
+    items = []
+    for f in files:
+        if not isinstance(f, ArenaFile):
+            if os.path.basename(f) != ARENA_FILENAME:
+                try:
+                    size = os.path.getsize(f)
+                except OSError:
+                    # Gone already, leave it to _open_files.
+                    size = 0
+                items.append((size, f))
+                continue
+            f = ArenaFile(f)
+        pids = f.pids
+        if pids is None:
+            pids = _arena_pids(os.path.dirname(f.path) or '.')
+        pids = sorted(pids)
+        try:
+            size = os.path.getsize(f.path)
+        except OSError:
+            size = 0
+        for i in range(min(n, len(pids))):
+            share = pids[i::n]
+            # Assuming pids have a similar share of the arena.
+            items.append((size * len(share) // len(pids), ArenaFile(f.path, share, f.prefixes)))
+    # Largest first, each to the least loaded share.
+    items.sort(key=lambda item: item[0], reverse=True)
+    shares = [[0, []] for _ in range(min(n, len(items)))]
+    for size, f in items:
+        share = min(shares, key=lambda share: share[0])
+        share[0] += size
+        share[1].append(f)
+    return [share for _, share in shares]
+
+
+def _load_share(args):
+    """Load the metrics of one share of the files, in a pool process."""
+    files, metric_names = args
+    return load_metrics_from_files(files, metric_names=metric_names)
+
+
+def _combine(partials):
+    """Combine the metrics loaded from disjoint shares of the files."""
+    metrics = {}
+    for partial in partials:
+        for metric_name, metric in six.iteritems(partial):
+            current = metrics.get(metric_name)
+            if current is None:
+                metrics[metric_name] = metric
+                continue
+            mode = getattr(metric, '_multiprocess_mode', None)
+            if mode:
+                current._multiprocess_mode = mode
+            current.samples.extend(metric.samples)
+    for metric in six.itervalues(metrics):
+        # Each share reduced its own files, reduce the shares.
+        if metric.type in _ADDITIVE_TYPES:
+            totals = defaultdict(float)
+            for s in metric.samples:
+                totals[s.name, s.labels] += s.value
+            metric.samples = [Sample(name, labels, value) for (name, labels), value in six.iteritems(totals)]
+        elif _is_reduced(metric.type, getattr(metric, '_multiprocess_mode', None)):
+            folded = {}
+            fold = _GAUGE_FOLDS.get(metric._multiprocess_mode)
+            for s in metric.samples:
+                _fold_into(folded, (s.name, s.labels), fold, s.value, s.timestamp)
+            metric.samples = [
+                Sample(name, labels, value, timestamp) for (name, labels), (value, timestamp) in six.iteritems(folded)]
+    return metrics
+
+
+class ArenaFile(object):
+    """The segments of an arena file to merge.
+
+    Optionally only those of some pids and file prefixes. merge and
+    load_metrics_from_files take these in place of paths; a plain path to an
+    arena file reads all of its segments.
+    """
+
+    def __init__(self, path, pids=None, prefixes=None):
+        self.path = path
+        self.pids = pids
+        self.prefixes = prefixes
+
+
+def _open_files(files):
+    """Yield (typ, multiprocess_mode, pid, d) for the files to read.
+
+    Each d is a MmapedDict, or a segment when reading an arena, which is
+    closed once the caller moves on to the next one.
+    """
+    for f in files:
+        if not isinstance(f, ArenaFile):
+            if os.path.basename(f) != ARENA_FILENAME:
+                parts = os.path.splitext(os.path.basename(f))[0].split('_')
+                typ = parts[0]
+                multiprocess_mode = parts[1] if typ == Gauge._type else None
+                pid = parts[2] if multiprocess_mode and len(parts) > 2 else None
+                try:
+                    d = MmapedDict(f, read_mode=True)
+                except EnvironmentError:
+                    # The liveall and livesum gauge metrics
+                    # are deleted when the gunicorn/celery worker process dies
+                    # (mark_process_dead and, in postal-main, boot.gunicornconf.child_exit).
+                    # Since these are deleted without acquiring a lock, they may
+                    # not be present in between collecting the metrics files and
+                    # merging them, resulting in a FileNotFoundError/IOError.
+                    # However, since these gauges only care about live processes,
+                    # we wouldn't merge them anyway.
+                    #
+                    # Additionally, we have a single thread which will collect
+                    # metrics files from dead workers, and merge them into a set of
+                    # archive files at regular interviews (see
+                    # multiprocess_exporter). This operation is protected by a
+                    # mutex, ensuring that no collectors are run during cleanup. We
+                    # must do so because other metrics are sensitive to partial
+                    # collection; prometheus counters cannot be decremented, as
+                    # prometheus will assume that, in the time since the last scrape,
+                    # the counter reset to 0 and incremented back up to the
+                    # collected value, manifesting as a huge rate spike
+                    if typ == 'gauge' and parts[1] in (Gauge.LIVESUM, Gauge.LIVEALL):
+                        continue
+                    raise
+                try:
+                    yield typ, multiprocess_mode, pid, d
+                finally:
+                    d.close()
+                continue
+            f = ArenaFile(f)
+
+        try:
+            arena = MmapedArena(f.path, read_mode=True)
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        try:
+            for segment in arena.segments(pids=f.pids, prefixes=f.prefixes):
+                typ, _, multiprocess_mode = segment.prefix.partition('_')
+                pid = str(segment.pid) if multiprocess_mode else None
+                yield typ, multiprocess_mode or None, pid, segment
+        finally:
+            arena.close()
+
+
+def _decode_key(key, pid):
+    """Decode a key into (metric_name, name, labels_key)."""
+    metric_name, name, labels = decode_key(key)
+    if pid:
+        labels["pid"] = pid
+    return metric_name, name, tuple(sorted(labels.items()))
+
+
 def mark_process_dead(pid, path=None):
     """Do bookkeeping for when one process dies in a multi-process setup."""
     path = _multiproc_dir() if path is None else path
     _remove_livesum_dbs(pid, path=path)
+    if not os.path.exists(os.path.join(path, ARENA_FILENAME)):
+        return
+    # Collectors may still be reading the retired segments, so they're only
+    # freed under the exclusive lock. Without waiting for it, as this is
+    # typically called by the master process, which the archiver frees them
+    # for otherwise.
+    try:
+        with advisory_lock(LOCK_EX | LOCK_NB, prom_dir=path):
+            _free_retired_segments(path)
+    except EnvironmentError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
 
 
 def _remove_livesum_dbs(pid, path):
     for gauge_type in [Gauge.LIVESUM, Gauge.LIVEALL]:
         _safe_remove("{}/gauge_{}_{}.db".format(path, gauge_type, pid))
+    _retire_arena_segments((int(pid),), _LIVE_PREFIXES, path)
+
+
+def _open_arena(path):
+    """Open the arena in path for writing, or return None if there's none."""
+    arena_path = os.path.join(path, ARENA_FILENAME)
+    if not os.path.exists(arena_path):
+        return None
+    return MmapedArena(arena_path)
+
+
+def _free_arena_segments(pids, prefixes, path):
+    arena = _open_arena(path)
+    if arena is None:
+        return
+    try:
+        segments = arena.segments(pids=pids, prefixes=prefixes)
+        arena.free([segment._base for segment in segments])
+    finally:
+        arena.close()
+
+
+def _retire_arena_segments(pids, prefixes, path):
+    arena = _open_arena(path)
+    if arena is None:
+        return
+    try:
+        segments = arena.segments(pids=pids, prefixes=prefixes)
+        arena.retire([segment._base for segment in segments])
+    finally:
+        arena.close()
+
+
+def _free_retired_segments(path):
+    """Free retired arena segments. The exclusive advisory lock must be held."""
+    arena = _open_arena(path)
+    if arena is None:
+        return
+    try:
+        arena.free_retired()
+    finally:
+        arena.close()
+
+
+def _arena_pids(path):
+    """Return the pids owning segments of the arena in path."""
+    arena_path = os.path.join(path, ARENA_FILENAME)
+    if not os.path.exists(arena_path):
+        return set()
+    arena = MmapedArena(arena_path, read_mode=True)
+    try:
+        return set(segment.pid for segment in arena.segments())
+    finally:
+        arena.close()
 
 
 def _multiproc_dir():
@@ -249,41 +814,140 @@ def _multiproc_dir():
 
 
 def _get_archive_paths(prom_dir=None):
+    """Return the paths of the current archive files, which may not exist."""
     prom_dir = _multiproc_dir() if prom_dir is None else prom_dir
-    merged_paths = {
-        (Histogram._type, None): "histogram.db",
-        (Counter._type, None): "counter.db",
-        (Gauge._type, Gauge.LATEST): "gauge_{}.db".format(Gauge.LATEST),
-        (Gauge._type, Gauge.MAX): "gauge_{}.db".format(Gauge.MAX),
-        (Gauge._type, Gauge.MIN): "gauge_{}.db".format(Gauge.MIN),
-    }
-    merged_paths = {
-        k: os.path.join(prom_dir, f) for k, f in six.iteritems(merged_paths)
+    archive_dir = os.path.join(prom_dir, ARCHIVE_LINK)
+    if not os.path.isdir(archive_dir):
+        # Nothing archived yet, or only by an older version.
+        archive_dir = prom_dir
+    return {
+        k: os.path.join(archive_dir, f) for k, f in six.iteritems(_ARCHIVE_FILENAMES)
     }
-    return merged_paths
+
+
+def _archived_pids(prom_dir):
+    """Return the pids merged into the current archive generation."""
+    try:
+        with open(os.path.join(prom_dir, ARCHIVE_LINK, _ARCHIVED_PIDS), 'rb') as f:
+            return set(int(line) for line in f.read().split())
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return set()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_archived_pids(archive_dir, pids):
+    """Replace the list of pids merged into the generation in archive_dir."""
+    path = os.path.join(archive_dir, _ARCHIVED_PIDS)
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, ''.join('{0}\n'.format(pid) for pid in sorted(pids)).encode('ascii'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(path + '.tmp', path)
+
+
+def _write_archive(deltas, prom_dir, pids):
+    """Write a new archive generation with the deltas added, and switch to it.
+
+    The files of the current generation are copied to a new archive.<n>
+    directory, and the deltas added to the copies in place: summed for
+    counters and histograms, and folded in by the gauge's mode otherwise.
+    Series which are new are appended. The generation is synced along with
+    the pids merged into it, and then switched to in one step by replacing
+    the archive symlink. A crash leaves either the old or the new
+    generation in place, never a mix. Directories of generations which
+    weren't switched to are removed on the next write.
+    """
+    link = os.path.join(prom_dir, ARCHIVE_LINK)
+    current = os.readlink(link) if os.path.islink(link) else None
+    for path in glob.glob(link + '.*'):
+        if os.path.basename(path) == current:
+            continue
+        if os.path.islink(path) or not os.path.isdir(path):
+            _safe_remove(path)
+        else:
+            shutil.rmtree(path)
+    generation = int(current.rpartition('.')[2]) + 1 if current else 1
+    name = '{0}.{1}'.format(ARCHIVE_LINK, generation)
+    new_dir = os.path.join(prom_dir, name)
+    os.mkdir(new_dir)
+    _add_deltas(deltas, _get_archive_paths(prom_dir), dict(
+        (k, os.path.join(new_dir, f)) for k, f in six.iteritems(_ARCHIVE_FILENAMES)))
+    _write_archived_pids(new_dir, pids)
+    _fsync_dir(new_dir)
+    # Renaming a new symlink over the old one switches atomically.
+    os.symlink(name, link + '.tmp')
+    os.rename(link + '.tmp', link)
+    _fsync_dir(prom_dir)
+    if current is not None:
+        shutil.rmtree(os.path.join(prom_dir, current))
+    for f in _ARCHIVE_FILENAMES.values():
+        # Copied into this generation if written by an older version.
+        _safe_remove(os.path.join(prom_dir, f))
 
 
 def cleanup_process(pid, prom_dir=None):
     """Aggregate dead worker's metrics into a single archive file."""
-    prom_dir = _multiproc_dir() if prom_dir is None else prom_dir
+    cleanup_processes([pid], prom_dir)
+
 
-    merged_paths = _get_archive_paths(prom_dir)
-    worker_paths = [
-        "counter_{}.db".format(pid),
-        "gauge_{}_{}.db".format(Gauge.LATEST, pid),
-        "gauge_{}_{}.db".format(Gauge.MAX, pid),
-        "gauge_{}_{}.db".format(Gauge.MIN, pid),
-        "histogram_{}.db".format(pid),
-    ]
-    worker_paths = (os.path.join(prom_dir, f) for f in worker_paths)
-    worker_paths = list(filter(os.path.exists, worker_paths))
-    if worker_paths:
-        all_paths = worker_paths + list(filter(os.path.exists, merged_paths.values()))
-        metrics = merge(all_paths, accumulate=False)
-        _write_metrics(metrics, merged_paths)
+def cleanup_processes(pids, prom_dir=None):
+    """Aggregate the metrics of dead workers into the archive files.
+
+    All of their files are merged at once, into one new archive generation.
+    The pids are listed in the generation until their files are removed,
+    so they aren't merged twice if that's interrupted.
+    """
+    prom_dir = _multiproc_dir() if prom_dir is None else prom_dir
+    pids = set(int(pid) for pid in pids)
+    index = PidIndex(prom_dir)
+    for pid in pids:
+        index.claim(pid)
+    archived = _archived_pids(prom_dir)
+    arena_pids = _arena_pids(prom_dir)
+    worker_paths = []
+    to_merge = []
+    for pid in pids:
+        for prefix in _ARCHIVED_PREFIXES:
+            path = os.path.join(prom_dir, '{0}_{1}.db'.format(prefix, pid))
+            if os.path.exists(path):
+                worker_paths.append(path)
+                # Unless it was archived already, but the archiver crashed
+                # before removing its files.
+                if pid not in archived:
+                    to_merge.append(path)
+    in_arena = pids & arena_pids
+    if in_arena - archived:
+        to_merge.append(ArenaFile(
+            os.path.join(prom_dir, ARENA_FILENAME), pids=in_arena - archived, prefixes=_ARCHIVED_PREFIXES))
+    if to_merge:
+        # Pids archived earlier are kept while they may still have files.
+        remaining = set(index.pids()) | arena_pids
+        _write_archive(load_metrics_from_files(to_merge), prom_dir, (archived & remaining) | pids)
     for worker_path in worker_paths:
         _safe_remove(worker_path)
-    _remove_livesum_dbs(pid, path=prom_dir)
+    if in_arena:
+        _free_arena_segments(in_arena, _ARCHIVED_PREFIXES, prom_dir)
+    # The files are gone, so a new process reusing one of the pids has
+    # files of its own, which must be merged rather than taken for these.
+    archived = _archived_pids(prom_dir)
+    if archived & pids:
+        archive_dir = os.path.join(prom_dir, ARCHIVE_LINK)
+        _write_archived_pids(archive_dir, archived - pids)
+        _fsync_dir(archive_dir)
+    for pid in pids:
+        _remove_livesum_dbs(pid, path=prom_dir)
+        index.release(pid)
 
 
 def _safe_remove(p):
@@ -294,33 +958,58 @@ def _safe_remove(p):
             raise
 
 
-def _write_metrics(metrics, metric_type_to_dst_path):
-    # TODO: use of mktemp is discouraged
-    mmaped_dicts = defaultdict(lambda: MmapedDict(tempfile.mktemp()))
-    for metric in metrics:
-        if metric.type not in [Histogram._type, Counter._type, Gauge._type]:
-            continue
+def _add_deltas(deltas, src_paths, dst_paths):
+    """Write the archive files at src_paths plus the deltas to dst_paths.
+
+    `deltas` are metrics as returned by load_metrics_from_files, so with one
+    sample per series. New files are synced to disk.
+    """
+    mmaped_dicts = {}
+
+    def open_dst(k):
+        # O_EXCL, as the files must be new to switch to them safely.
+        fd = os.open(dst_paths[k], os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(fd, 'wb') as dst:
+            if os.path.exists(src_paths[k]):
+                with open(src_paths[k], 'rb') as src:
+                    shutil.copyfileobj(src, dst)
+        d = mmaped_dicts[k] = MmapedDict(dst_paths[k])
+        return d
+
+    for metric in six.itervalues(deltas):
         mode = None
         if metric.type == Gauge._type:
             mode = metric._multiprocess_mode
-            if mode not in [Gauge.MIN, Gauge.MAX, Gauge.LATEST]:
-                continue
-        sink = mmaped_dicts[metric.type, mode]
-
+        if (metric.type, mode) not in _ARCHIVE_FILENAMES:
+            continue
+        sink = mmaped_dicts.get((metric.type, mode)) or open_dst((metric.type, mode))
+        fold = _GAUGE_FOLDS.get(mode)
         for sample in metric.samples:
-            # prometheus_client 0.4+ adds extra fields
-            key = mmap_key(
-                metric.name,
-                sample.name,
-                tuple(sample.labels),
-                tuple(sample.labels.values()),
-            )
-            sink.write_value(key, sample.value, timestamp=sample.timestamp)
-    for k, mmaped_dict in six.iteritems(mmaped_dicts):
+            labels = dict(sample.labels)
+            key = mmap_key(metric.name, sample.name, tuple(labels), tuple(labels.values()))
+            value, timestamp = sample.value, sample.timestamp
+            if key in sink:
+                current, current_timestamp = sink.read_value_timestamp(key)
+                if mode is None:
+                    value += current
+                elif fold is not None:
+                    value = fold(current, value)
+                elif current_timestamp is not None and (timestamp is None or current_timestamp >= timestamp):
+                    # Latest mode, and the archived value is more recent.
+                    continue
+            sink.write_value(key, value, timestamp=timestamp)
+    for k in dst_paths:
+        if k not in mmaped_dicts and os.path.exists(src_paths[k]):
+            # Unchanged, and never written once switched to, so can be shared.
+            os.link(src_paths[k], dst_paths[k])
+    for mmaped_dict in mmaped_dicts.values():
+        mmaped_dict.sync()
         mmaped_dict.close()
-        dst_path = metric_type_to_dst_path[k]
-        # Replace existing file:
-        shutil.move(mmaped_dict._fname, dst_path)
+
+
+# Multiprocess directories found to have all their files in the pid index,
+# which later archive passes don't list.
+_fully_indexed = set()
 
 
 def _is_alive(pid):
@@ -333,7 +1022,7 @@ def _is_alive(pid):
         return True
 
 
-def archive_metrics(root=None, blocking=True, aggregate_only=False):
+def archive_metrics(root=None, blocking=True, aggregate_only=False, processes=None):
     """Cleanup/merge database files from dead processes
 
     This is not threadsafe and should only be called from one thread/process at
@@ -356,6 +1045,9 @@ def archive_metrics(root=None, blocking=True, aggregate_only=False):
     merging-and-deleting process. Although it would be better to mock
     _is_alive, mock is only built into python in versions 3.3 and up, and we'd
     like to avoid introducing additional dependencies to this library
+
+    With `processes` greater than one, the metrics are merged in a pool of
+    that many processes, see merge.
     """
     start_time = time.time()
     if root is None:
@@ -364,53 +1056,173 @@ def archive_metrics(root=None, blocking=True, aggregate_only=False):
     live_metrics_paths = []
 
     # Collect all files which belonged to dead workers
-    for dirname, _, filenames in os.walk(root):
-        for fname in filenames:
+    pids_alive = {}
+
+    def is_alive(pid):
+        if pid not in pids_alive:
+            pids_alive[pid] = _is_alive(pid)
+            if not pids_alive[pid]:
+                pids_to_clean.add(pid)
+        return pids_alive[pid]
+
+    index = PidIndex(root)
+    has_index = index.exists()
+    indexed = set()
+    for pid in index.pids():
+        pid_is_alive = is_alive(pid)
+        for prefix in index.prefixes(pid):
+            indexed.add((prefix, pid))
+            path = os.path.join(root, '{0}_{1}.db'.format(prefix, pid))
+            # Unless it's not created yet, or removed on death.
+            if (pid_is_alive or aggregate_only) and os.path.exists(path):
+                live_metrics_paths.append(path)
+    if not has_index or root not in _fully_indexed:
+        # Files which aren't indexed, written by an older version, which
+        # are looked for until none are left.
+        unindexed = False
+        for fname in os.listdir(root):
             m = _db_pattern.match(fname)
             if not m:
                 continue
-            name, pid = m.groups()
-            pid = int(pid)
-            pid_is_alive = _is_alive(pid)
-            if pid not in pids_to_clean and not pid_is_alive:
-                pids_to_clean.add(pid)
-            if pid_is_alive or aggregate_only:
-                live_metrics_paths.append(os.path.join(dirname, fname))
+            pid = int(m.group(2))
+            if (m.group(1), pid) in indexed:
+                continue
+            unindexed = True
+            if is_alive(pid) or aggregate_only:
+                live_metrics_paths.append(os.path.join(root, fname))
+        if has_index and not unindexed:
+            _fully_indexed.add(root)
+    live_arena_pids = set()
+    for pid in _arena_pids(root):
+        if is_alive(pid) or aggregate_only:
+            live_arena_pids.add(pid)
+    if live_arena_pids:
+        live_metrics_paths.append(ArenaFile(os.path.join(root, ARENA_FILENAME), pids=live_arena_pids))
     lock_type = LOCK_EX if blocking else LOCK_EX | LOCK_NB
-    with advisory_lock(lock_type):
-        for pid in pids_to_clean:
-            logging.info("cleaning up worker %r", pid)
-            if not aggregate_only:
-                cleanup_process(pid)
+    with advisory_lock(lock_type, prom_dir=root):
+        if pids_to_clean and not aggregate_only:
+            logging.info("cleaning up workers %r", sorted(pids_to_clean))
+            cleanup_processes(pids_to_clean, root)
+        # Those of dead processes whose live gauges couldn't be freed when
+        # marked dead.
+        _free_retired_segments(root)
     # TODO: Skip this step if we're using a MultiprocessCollector
 
-    # Merge metrics and cache the results
-    archive_paths = list(filter(os.path.exists, _get_archive_paths(root).values()))
-    metrics = merge(archive_paths + live_metrics_paths, accumulate=True)
+    # Merge metrics and cache the results, under a shared lock like
+    # collectors, so arena segments aren't freed while being read.
+    lock_type = LOCK_SH if blocking else LOCK_SH | LOCK_NB
+    with advisory_lock(lock_type, prom_dir=root):
+        archive_paths = list(filter(os.path.exists, _get_archive_paths(root).values()))
+        metrics = merge(archive_paths + live_metrics_paths, accumulate=True,
+                        cache=_archive_file_cache, processes=processes)
     time_elapsed = time.time() - start_time
     _metrics_cache.write_metrics(metrics, time_elapsed)
 
 
+class LockTimeout(EnvironmentError):
+    """Raised when an advisory lock can't be acquired in time."""
+
+
+class AdvisoryLock(object):
+    """A flock on a file, with timeouts.
+
+    Each acquisition locks a file object of its own, as flocks through the
+    same open file don't exclude each other, even in different threads. The
+    file objects are kept open once released, for later acquisitions of
+    the process to reuse rather than open the file again.
+    """
+
+    # Released file objects kept open
+    max_idle = 4
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._pid = os.getpid()
+        self._idle = []
+
+    def acquire(self, lock_type, timeout=None):
+        """Acquire the lock, returning the file object to release it with.
+
+        With a timeout (in seconds), raises LockTimeout if it can't be
+        acquired in that time. flock can't wait with a timeout, so it's
+        retried at increasing intervals, of at most 50ms.
+        """
+        f = self._get_file()
+        try:
+            if timeout is None or lock_type & LOCK_NB:
+                flock(f, lock_type)
+                return f
+            deadline = time.time() + timeout
+            delay = 0.001
+            while True:
+                try:
+                    flock(f, lock_type | LOCK_NB)
+                    return f
+                except EnvironmentError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LockTimeout(errno.EAGAIN, 'Timed out acquiring lock', self._path)
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.05)
+        except BaseException:
+            self._put_file(f)
+            raise
+
+    def release(self, f):
+        """Release the lock acquired with the file object f."""
+        flock(f, LOCK_UN)
+        self._put_file(f)
+
+    def _get_file(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked, and the files are shared with the parent.
+                for f in self._idle:
+                    f.close()
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop()
+        return open(self._path, 'a')
+
+    def _put_file(self, f):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.max_idle:
+                self._idle.append(f)
+                return
+        f.close()
+
+
+_advisory_locks = {}
+_advisory_locks_lock = Lock()
+
+
 @contextmanager
-def advisory_lock(lock_type, filename="lockfile", prom_dir=None):
+def advisory_lock(lock_type, filename="lockfile", prom_dir=None, timeout=None):
     """
     Wrapper around flock.
     The cleanup thread acquires an LOCK_EX
     The metrics collectors acquire LOCK_SH
 
-    The flock interface in python makes it difficult to properly time out lock
-    acquisition, and lock acquisition is blocking (a non-blocking lock
-    acquisition will immediately fail with an IOError). This should be fine, as
-    metrics are not exposed to the wider internet, and gets a predictable, and
-    low, request volume. Since they only acquire shared locks, the only
-    contention is with the exclusive lock acquired by the cleanup operation,
-    which only runs once a minute
+    Lock acquisition is blocking, unless LOCK_NB is given, which makes it
+    immediately fail with an IOError, or a timeout (in seconds), after
+    which it fails with a LockTimeout. Since collectors only acquire
+    shared locks, the only contention is with the exclusive lock acquired
+    by the cleanup operation.
+
+    The lock file is kept open between uses, see AdvisoryLock.
     """
     prom_dir = _multiproc_dir() if prom_dir is None else prom_dir
     path = os.path.join(prom_dir, filename)
-    with open(path, 'w') as fd:
-        flock(fd, lock_type)
-        try:
-            yield
-        finally:
-            flock(fd, LOCK_UN)
+    with _advisory_locks_lock:
+        lock = _advisory_locks.get(path)
+        if lock is None:
+            lock = _advisory_locks[path] = AdvisoryLock(path)
+    f = lock.acquire(lock_type, timeout)
+    try:
+        yield
+    finally:
+        lock.release(f)
@@ -1,4 +1,10 @@
+import ctypes
+import ctypes.util
+import errno
 import logging
+import os
+import select
+import sys
 
 from .vendor import six
 
@@ -11,18 +17,129 @@ import traceback
 
 from . import (CollectorRegistry, multiprocess)
 from .exposition import make_wsgi_app
-from .multiprocess import archive_metrics
+from .multiprocess import _arena_pids, _multiproc_dir, archive_metrics
+from .pid_index import PidIndex
 
 
 CLEANUP_INTERVAL = 5.0
 
+# From <sys/inotify.h>
+_IN_CREATE = 0x100
+_IN_MOVED_TO = 0x80
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
 registry = CollectorRegistry()
 multiprocess.InMemoryCollector(registry)
 app = make_wsgi_app(registry)
 log = logging.getLogger(__name__)
 
 
+def _inotify_fd(path):
+    """Return an inotify fd for files created in path, or None if unsupported."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (AttributeError, OSError):
+        return None
+    fd = inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if not isinstance(path, bytes):
+        path = path.encode(sys.getfilesystemencoding())
+    if inotify_add_watch(fd, path, _IN_CREATE | _IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class _Watcher(object):
+    """Waits for workers using a multiprocess directory to exit.
+
+    Workers are tracked with pidfds where os.pidfd_open is available. On
+    Linux, inotify tells when new workers create their files, so they're
+    tracked right away rather than from the next wait. Without pidfds,
+    waiting just takes the whole timeout.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._inotify = _inotify_fd(path)
+        self._pidfds = {}
+        # Pids which exited, but weren't archived yet.
+        self._exited = set()
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for a worker to exit."""
+        if not hasattr(select, 'poll'):
+            time.sleep(timeout)
+            return
+        deadline = time.time() + timeout
+        while True:
+            poller = select.poll()
+            if self._inotify is not None:
+                poller.register(self._inotify, select.POLLIN)
+            if not self._track_pids(poller):
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            fds = dict((fd, pid) for pid, fd in six.iteritems(self._pidfds))
+            exited = False
+            for fd, _ in poller.poll(remaining * 1000):
+                if fd == self._inotify:
+                    # New workers are tracked from the next round.
+                    self._drain_inotify()
+                elif fd in fds:
+                    # Exited, and stays readable until archived, so stop polling it.
+                    os.close(self._pidfds.pop(fds[fd]))
+                    self._exited.add(fds[fd])
+                    exited = True
+            if exited:
+                return
+
+    def _track_pids(self, poller):
+        """Register pidfds of the workers, returning False if one already exited."""
+        if not hasattr(os, 'pidfd_open'):
+            return True
+        pids = set(PidIndex(self._path).pids()) | _arena_pids(self._path)
+        self._exited &= pids
+        for pid in list(self._pidfds):
+            if pid not in pids:
+                os.close(self._pidfds.pop(pid))
+        exited = False
+        for pid in pids - self._exited:
+            if pid not in self._pidfds:
+                try:
+                    self._pidfds[pid] = os.pidfd_open(pid)
+                except OSError as e:
+                    if e.errno == errno.ESRCH:
+                        self._exited.add(pid)
+                        exited = True
+                    # Otherwise it can't be tracked, leave it to the timeout.
+                    continue
+            poller.register(self._pidfds[pid], select.POLLIN)
+        return not exited
+
+    def _drain_inotify(self):
+        # Which files were created doesn't matter, only that some were.
+        while True:
+            try:
+                os.read(self._inotify, 4096)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+
+
 def archive_thread():
+    """Archive the files of dead workers, as soon as they exit where supported.
+
+    Otherwise, and also to refresh the metrics of live workers, every
+    CLEANUP_INTERVAL.
+    """
+    watcher = None
     while True:
         log.info("startup")
         try:
@@ -30,7 +147,13 @@ def archive_thread():
             archive_metrics()
         except Exception:
             traceback.print_exc()
-        time.sleep(CLEANUP_INTERVAL)
+        try:
+            if watcher is None:
+                watcher = _Watcher(_multiproc_dir())
+            watcher.wait(CLEANUP_INTERVAL)
+        except Exception:
+            traceback.print_exc()
+            time.sleep(CLEANUP_INTERVAL)
 
 
 def start_archiver_thread():
@@ -10,8 +10,16 @@ CONTENT_TYPE_LATEST = str('application/openmetrics-text; version=0.0.1; charset=
 
 def generate_latest(registry):
     '''Returns the metrics from the registry in latest text format as a string.'''
-    output = []
+    return b''.join(generate_latest_chunks(registry))
+
+
+def generate_latest_chunks(registry):
+    '''Yields the metrics from the registry in latest text format.
+
+    Each chunk is the utf-8 encoded output of one metric family.
+    '''
     for metric in registry.collect():
+        output = []
         try:
             mname = metric.name
             output.append('# HELP {0} {1}\n'.format(
@@ -60,6 +68,6 @@ def generate_latest(registry):
         except Exception as exception:
             exception.args = (exception.args or ('',)) + (metric,)
             raise
+        yield ''.join(output).encode('utf-8')
 
-    output.append('# EOF\n')
-    return ''.join(output).encode('utf-8')
+    yield b'# EOF\n'
@@ -0,0 +1,84 @@
+import errno
+import os
+
+PID_INDEX_DIRNAME = 'pids'
+"""Name of the pid index directory within the multiprocess directory"""
+
+# Suffix of the entries of pids whose files are being archived
+_CLAIMED_SUFFIX = '.archiving'
+
+
+class PidIndex(object):
+    """The pids with .db files in a multiprocess directory.
+
+    The directory has a subdirectory with a file per pid, listing the file
+    prefixes ('counter', 'gauge_livesum', ...) of its .db files, one per
+    line. Processes add a prefix before creating its file, so the archiver
+    can find the files of each pid, and the exporter watch the pids,
+    without matching every file name in the directory. Files which aren't
+    indexed, those of older versions, are found by name until none are
+    left. Arena files keep track of their pids themselves.
+    """
+
+    def __init__(self, path):
+        self._dir = os.path.join(path, PID_INDEX_DIRNAME)
+
+    def add(self, pid, prefix):
+        """Record that pid has a file with the given prefix."""
+        try:
+            os.mkdir(self._dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(os.path.join(self._dir, str(pid)), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            # Small appends are atomic, so other processes never see a partial line.
+            os.write(fd, (prefix + '\n').encode('ascii'))
+        finally:
+            os.close(fd)
+
+    def exists(self):
+        """Whether any process recorded its files yet."""
+        return os.path.isdir(self._dir)
+
+    def pids(self):
+        """Return the pids recorded."""
+        try:
+            names = os.listdir(self._dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return [int(name) for name in names if name.isdigit()]
+
+    def prefixes(self, pid):
+        """Return the file prefixes recorded for pid."""
+        try:
+            with open(os.path.join(self._dir, str(pid)), 'rb') as f:
+                lines = f.read().decode('ascii').splitlines()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(set(lines))
+
+    def claim(self, pid):
+        """Set the entry of pid aside, before archiving its files.
+
+        A new process reusing the pid meanwhile records its files in a new
+        entry, which release() leaves alone.
+        """
+        path = os.path.join(self._dir, str(pid))
+        try:
+            os.rename(path, path + _CLAIMED_SUFFIX)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def release(self, pid):
+        """Forget the entry of pid set aside by claim(), once its files are gone."""
+        try:
+            os.unlink(os.path.join(self._dir, str(pid) + _CLAIMED_SUFFIX))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
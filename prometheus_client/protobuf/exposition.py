@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+from __future__ import unicode_literals
+
+import struct
+
+CONTENT_TYPE_LATEST = str(
+    'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited')
+"""Content type of the delimited protobuf format"""
+
+# Field numbers and types of io.prometheus.client's metrics.proto.
+_COUNTER = 0
+_GAUGE = 1
+_SUMMARY = 2
+_UNTYPED = 3
+_HISTOGRAM = 4
+
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+_double = struct.Struct(b'<d').pack
+
+
+def _varint(value):
+    # Negative int64s are encoded as their 64 bit two's complement.
+    value &= 0xffffffffffffffff
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _tag(field, wire_type):
+    return _varint(field << 3 | wire_type)
+
+
+def _string_field(field, value):
+    encoded = value.encode('utf-8')
+    return _tag(field, _LENGTH_DELIMITED) + _varint(len(encoded)) + encoded
+
+
+def _double_field(field, value):
+    return _tag(field, _FIXED64) + _double(float(value))
+
+
+def _varint_field(field, value):
+    return _tag(field, _VARINT) + _varint(int(value))
+
+
+def _message_field(field, body):
+    return _tag(field, _LENGTH_DELIMITED) + _varint(len(body)) + body
+
+
+class _Series(object):
+    """The samples of one labelset of a metric family."""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0.0
+        self.count = 0
+        self.sum = 0.0
+        self.children = []
+        self.timestamp = None
+
+    def encode(self, mtype):
+        """Return the encoded io.prometheus.client.Metric."""
+        out = [_message_field(1, _string_field(1, k) + _string_field(2, v)) for k, v in self.labels]
+        if mtype == _COUNTER:
+            out.append(_message_field(3, _double_field(1, self.value)))
+        elif mtype == _GAUGE:
+            out.append(_message_field(2, _double_field(1, self.value)))
+        elif mtype == _UNTYPED:
+            out.append(_message_field(5, _double_field(1, self.value)))
+        elif mtype == _SUMMARY:
+            body = [_varint_field(1, self.count), _double_field(2, self.sum)]
+            for quantile, value in self.children:
+                body.append(_message_field(3, _double_field(1, quantile) + _double_field(2, value)))
+            out.append(_message_field(4, b''.join(body)))
+        else:
+            body = [_varint_field(1, self.count), _double_field(2, self.sum)]
+            for upper_bound, count in self.children:
+                body.append(_message_field(3, _varint_field(1, count) + _double_field(2, upper_bound)))
+            out.append(_message_field(7, b''.join(body)))
+        if self.timestamp is not None:
+            # Convert to milliseconds.
+            out.append(_varint_field(6, int(float(self.timestamp) * 1000)))
+        return b''.join(out)
+
+
+def _family(name, documentation, mtype, series):
+    """Return a length delimited io.prometheus.client.MetricFamily."""
+    body = [_string_field(1, name), _string_field(2, documentation), _varint_field(3, mtype)]
+    for s in series:
+        body.append(_message_field(4, s.encode(mtype)))
+    body = b''.join(body)
+    return _varint(len(body)) + body
+
+
+def _series_of(series, labels, excluded=None):
+    key = tuple(sorted((k, v) for k, v in labels.items() if k != excluded))
+    s = series.get(key)
+    if s is None:
+        s = series[key] = _Series(key)
+    return s
+
+
+def generate_latest(registry):
+    '''Returns the metrics from the registry in delimited protobuf format.'''
+    return b''.join(generate_latest_chunks(registry))
+
+
+def generate_latest_chunks(registry):
+    '''Yields the metrics from the registry in delimited protobuf format.
+
+    Each chunk holds the length delimited MetricFamily messages of one
+    metric family. As in the text format, _created, _gsum and _gcount
+    samples are exposed as separate gauges.
+    '''
+    for metric in registry.collect():
+        try:
+            mname = metric.name
+            mtype = metric.type
+            if mtype == 'counter':
+                mname = mname + '_total'
+                ptype = _COUNTER
+            elif mtype == 'info':
+                mname = mname + '_info'
+                ptype = _GAUGE
+            elif mtype in ('gauge', 'stateset'):
+                ptype = _GAUGE
+            elif mtype == 'summary':
+                ptype = _SUMMARY
+            elif mtype in ('histogram', 'gaugehistogram'):
+                # A gauge histogram is really a gauge,
+                # but this captures the structure better.
+                ptype = _HISTOGRAM
+            else:
+                ptype = _UNTYPED
+
+            series = {}
+            om_series = {}
+            for s in metric.samples:
+                suffix = s.name[len(metric.name):]
+                if suffix in ('_created', '_gsum', '_gcount'):
+                    # OpenMetrics specific sample, put in a gauge at the end.
+                    gauge = _series_of(om_series.setdefault(suffix, {}), s.labels)
+                    gauge.value = s.value
+                    gauge.timestamp = s.timestamp
+                    if suffix == '_created':
+                        continue
+                if ptype == _SUMMARY:
+                    if suffix == '_count':
+                        _series_of(series, s.labels).count = s.value
+                    elif suffix == '_sum':
+                        _series_of(series, s.labels).sum = s.value
+                    else:
+                        sample = _series_of(series, s.labels, 'quantile')
+                        sample.children.append((float(s.labels['quantile']), s.value))
+                        continue
+                elif ptype == _HISTOGRAM:
+                    if suffix == '_bucket':
+                        sample = _series_of(series, s.labels, 'le')
+                        sample.children.append((float(s.labels['le']), s.value))
+                        # Buckets are cumulative, so the last one is the count.
+                        sample.count = s.value
+                        continue
+                    elif suffix in ('_count', '_gcount'):
+                        _series_of(series, s.labels).count = s.value
+                    elif suffix in ('_sum', '_gsum'):
+                        _series_of(series, s.labels).sum = s.value
+                    continue
+                else:
+                    _series_of(series, s.labels).value = s.value
+                if s.timestamp is not None:
+                    _series_of(series, s.labels).timestamp = s.timestamp
+            output = [_family(mname, metric.documentation, ptype, _in_order(series))]
+        except Exception as exception:
+            exception.args = (exception.args or ('',)) + (metric,)
+            raise
+
+        for suffix, gauges in sorted(om_series.items()):
+            output.append(_family(metric.name + suffix, '', _GAUGE, _in_order(gauges)))
+        yield b''.join(output)
+
+
+def _in_order(series):
+    # Sorted by labels, to be deterministic.
+    return [series[key] for key in sorted(series)]
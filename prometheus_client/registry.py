@@ -1,8 +1,87 @@
 import copy
-from threading import Lock
+import os
+import sys
+from threading import Event, Lock, Thread
+import time
 
-from .metrics_core import Metric
+from .metrics_core import CounterMetricFamily, GaugeMetricFamily, Metric
 from .vendor import six
+from .vendor.six.moves import queue
+
+
+class _CollectorTask(object):
+    """One call of a collector's collect(), run by a _CollectorPool."""
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.started = Event()
+        self.done = Event()
+        self.start_time = None
+        self.duration = None
+        self.result = None
+        self.samples = 0
+        self.exc_info = None
+
+    def run(self):
+        self.start_time = time.time()
+        self.started.set()
+        try:
+            self.result = list(self.collector.collect())
+            self.samples = sum(len(m.samples) for m in self.result)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.duration = time.time() - self.start_time
+            self.done.set()
+
+    def wait(self, timeout):
+        """Wait for the collector to finish, at most timeout after it started.
+
+        Returns whether it finished. Waiting for it to start is bounded by
+        the timeout too.
+        """
+        if timeout is None:
+            self.done.wait()
+            return True
+        if not self.started.wait(timeout):
+            return False
+        remaining = self.start_time + timeout - time.time()
+        return self.done.wait(max(remaining, 0))
+
+
+class _CollectorPool(object):
+    """A bounded pool of daemon threads running collectors.
+
+    Daemon threads, so a collector which hangs doesn't also hang exit.
+    """
+
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._lock = Lock()
+        self._pid = None
+        self._queue = None
+        self._threads = 0
+
+    def submit(self, collector):
+        task = _CollectorTask(collector)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads don't survive a fork, start over in the child.
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._threads = 0
+            if self._threads < self._max_workers:
+                t = Thread(target=self._work, args=(self._queue,))
+                t.daemon = True
+                t.start()
+                self._threads += 1
+            self._queue.put(task)
+        return task
+
+    @staticmethod
+    def _work(tasks):
+        while True:
+            tasks.get().run()
 
 
 class CollectorRegistry(object):
@@ -11,13 +90,33 @@ class CollectorRegistry(object):
     Collectors must have a no-argument method 'collect' that returns a list of
     Metric objects. The returned metrics should be consistent with the Prometheus
     exposition formats.
+
+    With `max_workers`, collect() runs the collectors concurrently in a pool
+    of that many threads, and still returns their metrics in the order
+    they'd be returned otherwise. With a `collector_timeout` (in seconds)
+    as well, the metrics of a collector which hasn't finished that long
+    after it started are left out.
+
+    With `instrument` set, or `max_workers`, the registry also exposes how
+    long each collector took and how many samples it returned the last time,
+    how often it timed out, and how long it took to encode the metrics the
+    last time they were served by each format. Collectors are labelled by
+    their first metric name, or by their class name if they have none.
     """
 
-    def __init__(self, auto_describe=False):
+    def __init__(self, auto_describe=False, max_workers=None, collector_timeout=None, instrument=False):
         self._collector_to_names = {}
         self._names_to_collectors = {}
         self._auto_describe = auto_describe
         self._lock = Lock()
+        self._pool = _CollectorPool(max_workers) if max_workers else None
+        self._collector_timeout = collector_timeout
+        self._tasks = {}
+        self._instrument = bool(instrument or max_workers)
+        self._collector_durations = {}
+        self._collector_samples = {}
+        self._collector_timeouts = {}
+        self._encoder_durations = {}
 
     def register(self, collector):
         """Add a collector to the registry."""
@@ -38,6 +137,10 @@ class CollectorRegistry(object):
             for name in self._collector_to_names[collector]:
                 del self._names_to_collectors[name]
             del self._collector_to_names[collector]
+            self._tasks.pop(collector, None)
+            self._collector_durations.pop(collector, None)
+            self._collector_samples.pop(collector, None)
+            self._collector_timeouts.pop(collector, None)
 
     def _get_names(self, collector):
         """Get names of timeseries the collector produces."""
@@ -72,10 +175,112 @@ class CollectorRegistry(object):
         collectors = None
         with self._lock:
             collectors = copy.copy(self._collector_to_names)
-        for collector in collectors:
-            for metric in collector.collect():
+        if self._pool is not None:
+            for metric in self._collect_concurrently(collectors):
+                yield metric
+        elif self._instrument:
+            for collector in collectors:
+                start = time.time()
+                metrics = list(collector.collect())
+                self._record_collection(
+                    collector, time.time() - start, sum(len(m.samples) for m in metrics))
+                for metric in metrics:
+                    yield metric
+        else:
+            for collector in collectors:
+                for metric in collector.collect():
+                    yield metric
+            return
+        for metric in self._collector_metrics(collectors):
+            yield metric
+
+    def _record_collection(self, collector, duration, samples):
+        with self._lock:
+            # Unless it was unregistered while collecting.
+            if collector in self._collector_to_names:
+                self._collector_durations[collector] = duration
+                self._collector_samples[collector] = samples
+
+    def record_encoding(self, encoder, duration):
+        """Record how long encoding the metrics in some format took.
+
+        Called by the exposition functions serving the metrics. Only has an
+        effect on instrumented registries.
+        """
+        if self._instrument:
+            with self._lock:
+                self._encoder_durations[encoder] = duration
+
+    def _collect_concurrently(self, collectors):
+        tasks = []
+        with self._lock:
+            for collector in collectors:
+                task = self._tasks.get(collector)
+                if task is None or task.done.is_set():
+                    task = self._tasks[collector] = self._pool.submit(collector)
+                # Otherwise it's still running from an earlier collection
+                # which timed out, so wait for that rather than piling up.
+                tasks.append(task)
+        for task in tasks:
+            if not task.wait(self._collector_timeout):
+                with self._lock:
+                    if task.collector in self._collector_to_names:
+                        self._collector_timeouts[task.collector] = self._collector_timeouts.get(task.collector, 0) + 1
+                continue
+            if task.exc_info is not None:
+                six.reraise(*task.exc_info)
+            self._record_collection(task.collector, task.duration, task.samples)
+            for metric in task.result:
                 yield metric
 
+    def _collector_metrics(self, collectors):
+        """Return the metrics about the collectors themselves."""
+        durations = GaugeMetricFamily(
+            'prom_client_collector_duration_seconds',
+            'Duration of the last successful collection of each collector',
+            labels=['collector'])
+        samples = GaugeMetricFamily(
+            'prom_client_collector_samples',
+            'Number of samples returned by the last successful collection of each collector',
+            labels=['collector'])
+        metrics = [durations, samples]
+        if self._pool is not None:
+            timeouts = CounterMetricFamily(
+                'prom_client_collector_timeouts',
+                'Number of collections each collector did not finish in time',
+                labels=['collector'])
+            metrics.append(timeouts)
+        encoders = GaugeMetricFamily(
+            'prom_client_encoder_duration_seconds',
+            'Duration of encoding the metrics the last time they were served in each format',
+            labels=['encoder'])
+        metrics.append(encoders)
+        with self._lock:
+            for label, collector in self._collector_labels(collectors):
+                if collector in self._collector_durations:
+                    durations.add_metric([label], self._collector_durations[collector])
+                    samples.add_metric([label], self._collector_samples[collector])
+                if self._pool is not None:
+                    timeouts.add_metric([label], self._collector_timeouts.get(collector, 0))
+            for encoder, duration in sorted(self._encoder_durations.items()):
+                encoders.add_metric([encoder], duration)
+        return metrics
+
+    def _collector_labels(self, collectors):
+        """Yield (label, collector), labelling collectors uniquely."""
+        seen = {}
+        for collector in collectors:
+            names = collectors[collector]
+            if names:
+                # Names are unique within a registry.
+                yield min(names), collector
+                continue
+            label = type(collector).__name__
+            seen[label] = seen.get(label, 0) + 1
+            if seen[label] > 1:
+                label = '{0}_{1}'.format(label, seen[label])
+            yield label, collector
+
     def restricted_registry(self, names):
         """Returns object that only collects some metrics.
 
@@ -85,27 +290,48 @@ class CollectorRegistry(object):
         Intended usage is:
             generate_latest(REGISTRY.restricted_registry(['a_timeseries']))
 
+        Nothing is collected until collect() is called. Collectors with a
+        collect_names(names) method are asked for just the metrics with
+        samples of those names, and are asked even if they registered no
+        names, as they can't be found by name.
+
         Experimental."""
-        names = set(names)
+        names = frozenset(names)
+        registry = self
+
+        class RestrictedRegistry(object):
+            _instrument = registry._instrument
+
+            def collect(self):
+                return registry._collect_names(names)
+
+            def record_encoding(self, encoder, duration):
+                registry.record_encoding(encoder, duration)
+
+        return RestrictedRegistry()
+
+    def _collect_names(self, names):
         collectors = set()
         with self._lock:
             for name in names:
                 if name in self._names_to_collectors:
                     collectors.add(self._names_to_collectors[name])
+            for collector, collector_names in self._collector_to_names.items():
+                if not collector_names and hasattr(collector, 'collect_names'):
+                    collectors.add(collector)
         metrics = []
         for collector in collectors:
-            for metric in collector.collect():
+            if hasattr(collector, 'collect_names'):
+                collected = collector.collect_names(names)
+            else:
+                collected = collector.collect()
+            for metric in collected:
                 samples = [s for s in metric.samples if s[0] in names]
                 if samples:
                     m = Metric(metric.name, metric.documentation, metric.type)
                     m.samples = samples
                     metrics.append(m)
-
-        class RestrictedRegistry(object):
-            def collect(self):
-                return metrics
-
-        return RestrictedRegistry()
+        return metrics
 
     def get_sample_value(self, name, labels=None):
         """Returns the sample value, or None if not found.
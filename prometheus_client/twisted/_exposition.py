@@ -1,20 +1,66 @@
 from __future__ import absolute_import, unicode_literals
 
+from twisted.internet.interfaces import IPullProducer
+from twisted.python import log
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from zope.interface import implementer
 
 from .. import exposition, REGISTRY
 
 
+@implementer(IPullProducer)
+class _ChunkProducer(object):
+    """Writes the output of an encoder to a request a chunk at a time."""
+
+    def __init__(self, request, chunks):
+        self._request = request
+        self._chunks = chunks
+
+    def resumeProducing(self):
+        try:
+            chunk = next(self._chunks, None)
+        except Exception:
+            # Too late for an error response, so truncate it instead.
+            log.err(None, 'error generating metric output')
+            self._request.unregisterProducer()
+            self._request.loseConnection()
+            return
+        if chunk is None:
+            self._request.unregisterProducer()
+            self._request.finish()
+        else:
+            self._request.write(chunk)
+
+    def stopProducing(self):
+        self._chunks = iter(())
+
+
 class MetricsResource(Resource):
     """
     Twisted ``Resource`` that serves prometheus metrics.
+
+    The output is streamed a metric family at a time, and compressed at
+    ``compression_level`` for clients accepting it unless that is None.
     """
     isLeaf = True
 
-    def __init__(self, registry=REGISTRY):
+    def __init__(self, registry=REGISTRY, compression_level=6):
         self.registry = registry
+        self.compression_level = compression_level
 
     def render_GET(self, request):
         encoder, content_type = exposition.choose_encoder(request.getHeader('Accept'))
         request.setHeader(b'Content-Type', content_type.encode('ascii'))
-        return encoder(self.registry)
+        chunks = exposition.chunked_encoder(encoder)(self.registry)
+        if self.compression_level is not None:
+            request.setHeader(b'Vary', b'Accept-Encoding')
+            accept_encoding = request.getHeader('Accept-Encoding')
+            if isinstance(accept_encoding, bytes):
+                accept_encoding = accept_encoding.decode('ascii', 'replace')
+            content_encoding = exposition.choose_content_encoding(accept_encoding)
+            if content_encoding:
+                request.setHeader(b'Content-Encoding', content_encoding.encode('ascii'))
+                chunks = exposition.compress_chunks(chunks, content_encoding, self.compression_level)
+        request.registerProducer(_ChunkProducer(request, chunks), False)
+        return NOT_DONE_YET
@@ -4,6 +4,27 @@ import math
 INF = float("inf")
 MINUS_INF = float("-inf")
 
+# NumPy once imported, None if it isn't installed.
+_NOT_IMPORTED = object()
+numpy = _NOT_IMPORTED
+
+
+def _numpy():
+    """Return NumPy, or None if it isn't installed.
+
+    It's imported on first use rather than with the library, as it's only
+    used to read multiprocess files and to bin batches of observations, so
+    most processes never need it.
+    """
+    global numpy
+    if numpy is _NOT_IMPORTED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
 
 def floatToGoString(d):
     d = float(d)
@@ -1,9 +1,13 @@
 from __future__ import unicode_literals
 
+import atexit
 import os
-from threading import Lock
+from threading import Event, Lock, Thread
+import weakref
 
+from .mmap_arena import ARENA_FILENAME, ArenaDict, MmapedArena
 from .mmap_dict import mmap_key, MmapedDict
+from .pid_index import PidIndex
 
 
 class MutexValue(object):
@@ -11,16 +15,28 @@ class MutexValue(object):
 
     _multiprocess = False
 
-    def __init__(self, typ, metric_name, name, labelnames, labelvalues, **kwargs):
+    def __init__(self, typ, metric_name, name, labelnames, labelvalues, lock=None, **kwargs):
         self._value = 0.0
         self._timestamp = None
-        self._lock = Lock()
+        self._lock = lock or Lock()
 
     def inc(self, amount, timestamp=None):
         with self._lock:
             self._value += amount
             self._timestamp = timestamp
 
+    @staticmethod
+    def inc_all(updates):
+        """Increment several values sharing a lock, taking it only once.
+
+        updates is a sequence of (value, amount) pairs, whose values were
+        all created with the same lock.
+        """
+        with updates[0][0]._lock:
+            for value, amount in updates:
+                value._value += amount
+                value._timestamp = None
+
     def set(self, value, timestamp=None):
         with self._lock:
             self._value = value
@@ -35,77 +51,270 @@ class MutexValue(object):
             return self._timestamp
 
 
-def MultiProcessValue(_pidFunc=os.getpid):
+class _Flusher(object):
+    """Writes the buffered updates of all value classes periodically.
+
+    There is a single thread per process, started on the first buffered
+    update in that process, waking at the shortest flush interval.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._classes = []
+        self._pid = None
+        self._thread = None
+        self._stop = None
+
+    def register(self, value_class, interval):
+        with self._lock:
+            self._classes.append((weakref.ref(value_class), interval))
+            if self._stop is not None:
+                # Let the next buffered update start a thread waking at
+                # the new shortest interval.
+                self._stop.set()
+                self._pid = self._thread = self._stop = None
+
+    def _live(self):
+        with self._lock:
+            self._classes = [(ref, interval) for ref, interval in self._classes if ref() is not None]
+            return [(ref(), interval) for ref, interval in self._classes]
+
+    def start(self):
+        """Start the thread, unless it's already running in this process."""
+        # Threads don't survive a fork, so there's one per process.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._stop = Event()
+            self._thread = Thread(target=self._run, args=(self._stop,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, stop):
+        while True:
+            # Not holding on to the classes while waiting.
+            intervals = [interval for _, interval in self._live()]
+            if not intervals or stop.wait(min(intervals)):
+                return
+            for value_class, _ in self._live():
+                value_class.flush()
+
+    def stop(self):
+        """Stop the thread and write any remaining buffered updates."""
+        with self._lock:
+            pid, thread, stop = self._pid, self._thread, self._stop
+            self._pid = self._thread = self._stop = None
+        if thread is not None and pid == os.getpid():
+            stop.set()
+            thread.join()
+        for value_class, _ in self._live():
+            value_class.flush()
+
+
+_flusher = _Flusher()
+atexit.register(_flusher.stop)
+
+
+def MultiProcessValue(_pidFunc=os.getpid, use_arena=False, flush_interval=None):
+    """Return a value class backed by mmaped files.
+
+    With use_arena, all processes share a single arena file in the
+    multiprocess directory, rather than each having its own files.
+
+    With a flush_interval (in seconds), updates are only made in memory and
+    written to the files by a background thread at that interval, at exit,
+    and whenever flush() is called. Collectors may then see values up to
+    flush_interval old, or lose the last updates of a process which doesn't
+    exit cleanly.
+    """
     files = {}
+    arenas = {}
     values = []
+    # Values updated since the last flush, when buffering.
+    dirty = set()
     pid = {'value': _pidFunc()}
-    # Use a single global lock when in multi-processing mode
-    # as we presume this means there is no threading going on.
-    # This avoids the need to also have mutexes in __MmapDict.
-    lock = Lock()
+    # Guards the files shared by all values of the process, and the list of
+    # values. Updates of a value only take that value's own lock, so threads
+    # updating different values don't contend.
+    files_lock = {'value': Lock()}
+    # A fork is detected by an at-fork hook where available, rather than
+    # comparing pids on every call. A custom _pidFunc is always compared.
+    check_pid = not (_pidFunc is os.getpid and hasattr(os, 'register_at_fork'))
+    # Set by the at-fork hook, which leaves the actual reset to the first use.
+    forked = {'value': False}
+    # Bumped on each reset, values with an older one reopen their files.
+    generation = {'value': 0}
+
+    def reset_after_fork(actual_pid):
+        """Start over with the files of actual_pid. The files lock must be held by caller.
+
+        Values reopen their files lazily, on their next use, so a child which
+        never touches a metric doesn't create any files.
+        """
+        pid['value'] = actual_pid
+        for f in files.values():
+            f.close()
+        files.clear()
+        # The child needs its own open file for the arena's flock.
+        for arena in arenas.values():
+            arena.close()
+        arenas.clear()
+        # Updates buffered before the fork belong to the parent.
+        dirty.clear()
+        generation['value'] += 1
+
+    def check_for_fork():
+        if check_pid:
+            actual_pid = _pidFunc()
+            if pid['value'] != actual_pid:
+                with files_lock['value']:
+                    if pid['value'] != actual_pid:
+                        # There has been a fork(), start over with all the values.
+                        reset_after_fork(actual_pid)
+        elif forked['value']:
+            with files_lock['value']:
+                if forked['value']:
+                    forked['value'] = False
+                    reset_after_fork(os.getpid())
+
+    def flush():
+        """Write the dirty values. The files lock must be held by caller."""
+        while dirty:
+            try:
+                value = dirty.pop()
+            except KeyError:
+                break
+            with value._lock:
+                value._file.write_value(value._key, value._value, timestamp=value._timestamp)
 
     class MmapedValue(object):
         """A float protected by a mutex backed by a per-process mmaped file."""
 
         _multiprocess = True
 
-        def __init__(self, typ, metric_name, name, labelnames, labelvalues, multiprocess_mode='', **kwargs):
+        def __init__(self, typ, metric_name, name, labelnames, labelvalues, multiprocess_mode='', lock=None,
+                     **kwargs):
             self._params = typ, metric_name, name, labelnames, labelvalues, multiprocess_mode
-            with lock:
-                self.__check_for_pid_change()
-                self.__reset()
+            self._lock = lock or Lock()
+            check_for_fork()
+            with files_lock['value']:
+                self._reset()
                 values.append(self)
 
-        def __reset(self):
+        def _reset(self):
             typ, metric_name, name, labelnames, labelvalues, multiprocess_mode = self._params
             if typ == 'gauge':
                 file_prefix = typ + '_' + multiprocess_mode
             else:
                 file_prefix = typ
             if file_prefix not in files:
-                filename = os.path.join(
-                    os.environ['prometheus_multiproc_dir'],
-                    '{0}_{1}.db'.format(file_prefix, pid['value']))
-
-                files[file_prefix] = MmapedDict(filename)
+                if use_arena:
+                    if 'arena' not in arenas:
+                        arenas['arena'] = MmapedArena(os.path.join(
+                            os.environ['prometheus_multiproc_dir'], ARENA_FILENAME))
+                    files[file_prefix] = ArenaDict(arenas['arena'], file_prefix, pid['value'])
+                else:
+                    path = os.environ['prometheus_multiproc_dir']
+                    filename = os.path.join(path, '{0}_{1}.db'.format(file_prefix, pid['value']))
+                    # Before the file exists, so the archiver doesn't miss it.
+                    PidIndex(path).add(pid['value'], file_prefix)
+                    files[file_prefix] = MmapedDict(filename)
             self._file = files[file_prefix]
+            self._generation = generation['value']
             self._key = mmap_key(metric_name, name, labelnames, labelvalues)
             self._value, self._timestamp = self._file.read_value_timestamp(self._key)
 
-        def __check_for_pid_change(self):
-            actual_pid = _pidFunc()
-            if pid['value'] != actual_pid:
-                pid['value'] = actual_pid
-                # There has been a fork(), reset all the values.
-                for f in files.values():
-                    f.close()
-                files.clear()
-                for value in values:
-                    value.__reset()
+        def _check_for_pid_change(self):
+            check_for_fork()
+            if self._generation != generation['value']:
+                with files_lock['value']:
+                    if self._generation != generation['value']:
+                        self._reset()
 
         def inc(self, amount, timestamp=None):
-            with lock:
-                self.__check_for_pid_change()
+            self._check_for_pid_change()
+            with self._lock:
                 self._value += amount
                 self._timestamp = timestamp
-                self._file.write_value(self._key, self._value, timestamp=self._timestamp)
+                if flush_interval is None:
+                    # Writing a slot that already exists doesn't touch
+                    # anything shared with other values.
+                    self._file.write_value(self._key, self._value, timestamp=self._timestamp)
+                else:
+                    if not dirty:
+                        _flusher.start()
+                    dirty.add(self)
+
+        @staticmethod
+        def inc_all(updates):
+            """Increment several values sharing a lock, taking it only once.
+
+            updates is a sequence of (value, amount) pairs, whose values were
+            all created with the same lock.
+            """
+            for value, _ in updates:
+                value._check_for_pid_change()
+            if flush_interval is not None and not dirty:
+                _flusher.start()
+            with updates[0][0]._lock:
+                for value, amount in updates:
+                    value._value += amount
+                    value._timestamp = None
+                    if flush_interval is None:
+                        value._file.write_value(value._key, value._value)
+                    else:
+                        dirty.add(value)
 
         def set(self, value, timestamp=None):
-            with lock:
-                self.__check_for_pid_change()
+            self._check_for_pid_change()
+            with self._lock:
                 self._value = value
                 self._timestamp = timestamp
-                self._file.write_value(self._key, self._value, timestamp=self._timestamp)
+                if flush_interval is None:
+                    self._file.write_value(self._key, self._value, timestamp=self._timestamp)
+                else:
+                    if not dirty:
+                        _flusher.start()
+                    dirty.add(self)
 
         def get(self):
-            with lock:
-                self.__check_for_pid_change()
-                return self._value
+            self._check_for_pid_change()
+            return self._value
 
         def timestamp(self):
-            with lock:
-                self.__check_for_pid_change()
-                return self._timestamp
+            self._check_for_pid_change()
+            return self._timestamp
+
+        @staticmethod
+        def flush():
+            """Write any buffered updates of this process to the files."""
+            # A forked child mustn't write the parent's updates.
+            check_for_fork()
+            with files_lock['value']:
+                flush()
+
+    if flush_interval is not None:
+        _flusher.register(MmapedValue, flush_interval)
+
+    if not check_pid:
+        def after_in_child():
+            # Only the forking thread survives, so locks held by others at
+            # the time of the fork would never be released.
+            files_lock['value'] = Lock()
+            locks = {}
+            for value in values:
+                # Values created with a shared lock keep sharing one.
+                value._lock = locks.setdefault(id(value._lock), Lock())
+            # Only mark the values stale, as most children of e.g. a
+            # multiprocessing pool never touch them.
+            forked['value'] = True
+
+        os.register_at_fork(after_in_child=after_in_child)
+
     return MmapedValue
 
 
@@ -115,9 +324,24 @@ def get_value_class():
     # and as that may be in some arbitrary library the user/admin has
     # no control over we use an environment variable.
     if 'prometheus_multiproc_dir' in os.environ:
-        return MultiProcessValue()
+        flush_interval = os.environ.get('prometheus_multiproc_flush_interval')
+        return MultiProcessValue(
+            use_arena=bool(os.environ.get('prometheus_multiproc_arena')),
+            flush_interval=float(flush_interval) if flush_interval else None,
+        )
     else:
         return MutexValue
 
 
 ValueClass = get_value_class()
+
+
+def flush():
+    """Write buffered multiprocess updates of this process to the files.
+
+    Only has an effect when a flush interval is set, in which case it should
+    be called before a worker exits without running atexit handlers, e.g.
+    from gunicorn's worker_exit hook.
+    """
+    if hasattr(ValueClass, 'flush'):
+        ValueClass.flush()
@@ -16,6 +16,7 @@ setup(
         'prometheus_client',
         'prometheus_client.bridge',
         'prometheus_client.openmetrics',
+        'prometheus_client.protobuf',
         'prometheus_client.twisted',
         'prometheus_client.vendor'
     ],
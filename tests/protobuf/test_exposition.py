@@ -0,0 +1,195 @@
+from __future__ import unicode_literals
+
+import struct
+import sys
+import time
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Enum, Gauge, Histogram, Info, Metric, Summary,
+)
+from prometheus_client.core import GaugeHistogramMetricFamily
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.protobuf.exposition import (
+    CONTENT_TYPE_LATEST, generate_latest, generate_latest_chunks,
+)
+
+if sys.version_info < (2, 7):
+    # We need the skip decorators from unittest2 on Python 2.6.
+    import unittest2 as unittest
+else:
+    import unittest
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        b = bytearray(data[pos:pos + 1])[0]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return result, pos
+
+
+def _decode(data):
+    """Decode a protobuf message into a dict of field number to values."""
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        tag, pos = _read_varint(data, pos)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            value = struct.unpack('<d', data[pos:pos + 8])[0]
+            pos += 8
+        else:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def _families(data):
+    """Decode delimited MetricFamily messages into readable tuples."""
+    families = []
+    pos = 0
+    while pos < len(data):
+        length, pos = _read_varint(data, pos)
+        family = _decode(data[pos:pos + length])
+        pos += length
+        metrics = []
+        for m in family.get(4, []):
+            metric = _decode(m)
+            labels = {}
+            for label in metric.get(1, []):
+                pair = _decode(label)
+                labels[pair[1][0].decode('utf-8')] = pair[2][0].decode('utf-8')
+            value = {}
+            for field in (2, 3, 4, 5, 7):
+                if field in metric:
+                    value = _decode(metric[field][0])
+                    if 3 in value:
+                        # Quantiles or buckets.
+                        value[3] = [_decode(v) for v in value[3]]
+            metrics.append((labels, value, metric.get(6, [None])[0]))
+        families.append((
+            family[1][0].decode('utf-8'),
+            family[2][0].decode('utf-8'),
+            family[3][0],
+            metrics,
+        ))
+    return families
+
+
+class TestGenerateProtobuf(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+
+        # Mock time so _created values are fixed.
+        self.old_time = time.time
+        time.time = lambda: 123.456
+
+    def tearDown(self):
+        time.time = self.old_time
+
+    def families(self):
+        return _families(generate_latest(self.registry))
+
+    def test_counter(self):
+        c = Counter('cc', 'A counter', ['l'], registry=self.registry)
+        c.labels('x').inc(2)
+        self.assertEqual([
+            ('cc_total', 'A counter', 0, [({'l': 'x'}, {1: [2.0]}, None)]),
+            ('cc_created', '', 1, [({'l': 'x'}, {1: [123.456]}, None)]),
+        ], self.families())
+
+    def test_gauge(self):
+        g = Gauge('gg', 'A gauge', registry=self.registry)
+        g.set(17)
+        # Gauges in the default latest mode are timestamped when set.
+        self.assertEqual([('gg', 'A gauge', 1, [({}, {1: [17.0]}, 123456)])], self.families())
+
+    def test_summary(self):
+        s = Summary('ss', 'A summary', ['a', 'b'], registry=self.registry)
+        s.labels('c', 'd').observe(17)
+        self.assertEqual(
+            ('ss', 'A summary', 2, [({'a': 'c', 'b': 'd'}, {1: [1], 2: [17.0]}, None)]),
+            self.families()[0])
+
+    def test_histogram(self):
+        h = Histogram('hh', 'A histogram', buckets=[1, 2], registry=self.registry)
+        h.observe(0.5)
+        h.observe(1.5)
+        family = self.families()[0]
+        self.assertEqual(('hh', 'A histogram', 4), family[:3])
+        labels, value, _ = family[3][0]
+        self.assertEqual({}, labels)
+        self.assertEqual([2], value[1])
+        self.assertEqual([2.0], value[2])
+        self.assertEqual([
+            {1: [1], 2: [1.0]},
+            {1: [2], 2: [2.0]},
+            {1: [2], 2: [float('inf')]},
+        ], value[3])
+
+    def test_gaugehistogram(self):
+        self.registry.register(_Collector(GaugeHistogramMetricFamily(
+            'gh', 'help', buckets=[('1.0', 4), ('+Inf', 5)], gsum_value=7)))
+        families = self.families()
+        self.assertEqual(('gh', 'help', 4), families[0][:3])
+        self.assertEqual([5], families[0][3][0][1][1])
+        self.assertEqual([7.0], families[0][3][0][1][2])
+        self.assertEqual(['gh_gcount', 'gh_gsum'], [f[0] for f in families[1:]])
+
+    def test_info_and_enum(self):
+        i = Info('ii', 'info', registry=self.registry)
+        i.info({'a': 'b'})
+        e = Enum('ee', 'enum', states=['x', 'y'], registry=self.registry)
+        e.state('y')
+        families = self.families()
+        self.assertEqual(('ii_info', 'info', 1, [({'a': 'b'}, {1: [1.0]}, None)]), families[0])
+        self.assertEqual(('ee', 'enum', 1, [
+            ({'ee': 'x'}, {1: [0.0]}, None),
+            ({'ee': 'y'}, {1: [1.0]}, None),
+        ]), families[1])
+
+    def test_untyped_with_timestamp(self):
+        metric = Metric('ts', 'help', 'untyped')
+        metric.add_sample('ts', {'a': '䔀'}, 1, 123.456)
+        metric.add_sample('ts', {'a': 'b'}, 2, -1)
+        self.registry.register(_Collector(metric))
+        self.assertEqual([('ts', 'help', 3, [
+            ({'a': 'b'}, {1: [2.0]}, 2 ** 64 - 1000),
+            ({'a': '䔀'}, {1: [1.0]}, 123456),
+        ])], self.families())
+
+    def test_chunk_per_family(self):
+        Gauge('g1', 'help', registry=self.registry)
+        Gauge('g2', 'help', registry=self.registry)
+        chunks = list(generate_latest_chunks(self.registry))
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(b''.join(chunks), generate_latest(self.registry))
+
+    def test_choose_encoder(self):
+        self.assertEqual(
+            (generate_latest, CONTENT_TYPE_LATEST),
+            choose_encoder('application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+                           'encoding=delimited;q=0.7,text/plain;version=0.0.4;q=0.3,*/*;q=0.1'))
+        self.assertNotEqual(
+            generate_latest,
+            choose_encoder('application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+                           'encoding=text')[0])
+
+
+class _Collector(object):
+    def __init__(self, metric):
+        self.metric = metric
+
+    def collect(self):
+        return [self.metric]
+
+
+if __name__ == '__main__':
+    unittest.main()
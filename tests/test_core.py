@@ -2,10 +2,16 @@ from __future__ import unicode_literals
 
 from concurrent.futures import ThreadPoolExecutor
 import inspect
+import math
+import os
+import subprocess
+import sys
+import threading
 import time
 
 import pytest
 
+from prometheus_client import metrics, utils
 from prometheus_client.core import (
     CollectorRegistry, Counter, CounterMetricFamily, Enum, Gauge,
     GaugeHistogramMetricFamily, GaugeMetricFamily, Histogram,
@@ -13,6 +19,11 @@ from prometheus_client.core import (
     StateSetMetricFamily, Summary, SummaryMetricFamily, UntypedMetricFamily,
 )
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     import unittest2 as unittest
 except ImportError:
@@ -34,6 +45,19 @@ class TestCounter(unittest.TestCase):
     def test_negative_increment_raises(self):
         self.assertRaises(ValueError, self.counter.inc, -1)
 
+    def test_inc_many(self):
+        c = Counter('cl', 'help', ['l'], registry=self.registry)
+        c.inc_many([(('a',), 1), (('b',), 2), (('a',), 3)])
+        self.assertEqual(4, self.registry.get_sample_value('cl_total', {'l': 'a'}))
+        self.assertEqual(2, self.registry.get_sample_value('cl_total', {'l': 'b'}))
+        c.inc_many({('b',): 5})
+        self.assertEqual(7, self.registry.get_sample_value('cl_total', {'l': 'b'}))
+
+    def test_inc_many_negative_raises(self):
+        c = Counter('cl', 'help', ['l'], registry=self.registry)
+        self.assertRaises(ValueError, c.inc_many, [(('a',), 1), (('b',), -1)])
+        self.assertEqual(None, self.registry.get_sample_value('cl_total', {'l': 'a'}))
+
     def test_function_decorator(self):
         @self.counter.count_exceptions(ValueError)
         def f(r):
@@ -163,6 +187,13 @@ class TestSummary(unittest.TestCase):
         self.assertEqual(1, self.registry.get_sample_value('s_count'))
         self.assertEqual(10, self.registry.get_sample_value('s_sum'))
 
+    def test_observe_many(self):
+        self.summary.observe_many([1, 2, 3.5])
+        self.assertEqual(3, self.registry.get_sample_value('s_count'))
+        self.assertEqual(6.5, self.registry.get_sample_value('s_sum'))
+        self.summary.observe_many([])
+        self.assertEqual(3, self.registry.get_sample_value('s_count'))
+
     def test_function_decorator(self):
         self.assertEqual(0, self.registry.get_sample_value('s_count'))
 
@@ -269,6 +300,46 @@ class TestHistogram(unittest.TestCase):
         self.assertEqual(3, self.registry.get_sample_value('h_count'))
         self.assertEqual(float("inf"), self.registry.get_sample_value('h_sum'))
 
+    def test_observe_bucket_boundaries(self):
+        h = Histogram('hb', 'help', registry=self.registry, buckets=[0, 1, 2])
+        for amount in (-1, 0, 0.5, 1, 2, 3, float('nan')):
+            h.observe(amount)
+        self.assertEqual(2, self.registry.get_sample_value('hb_bucket', {'le': '0.0'}))
+        self.assertEqual(4, self.registry.get_sample_value('hb_bucket', {'le': '1.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('hb_bucket', {'le': '2.0'}))
+        # NaN goes in no bucket, though it is added to the sum.
+        self.assertEqual(6, self.registry.get_sample_value('hb_bucket', {'le': '+Inf'}))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('hb_sum')))
+
+    def test_observe_many(self):
+        h = Histogram('hb', 'help', registry=self.registry, buckets=[0, 1, 2])
+        h.observe_many([-1, 0, 0.5, 1, 2, 3, float('nan')])
+        self.assertEqual(2, self.registry.get_sample_value('hb_bucket', {'le': '0.0'}))
+        self.assertEqual(4, self.registry.get_sample_value('hb_bucket', {'le': '1.0'}))
+        self.assertEqual(5, self.registry.get_sample_value('hb_bucket', {'le': '2.0'}))
+        self.assertEqual(6, self.registry.get_sample_value('hb_bucket', {'le': '+Inf'}))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('hb_sum')))
+
+    def test_observe_many_matches_observe(self):
+        amounts = [i / 10.0 for i in range(200)]
+        self.histogram.observe_many(amounts)
+        self.labels.labels('a').observe_many(iter(amounts))
+        for amount in amounts:
+            self.labels.labels('b').observe(amount)
+        for le in ('0.005', '0.1', '1.0', '5.0', '10.0', '+Inf'):
+            expected = self.registry.get_sample_value('hl_bucket', {'le': le, 'l': 'b'})
+            self.assertEqual(expected, self.registry.get_sample_value('h_bucket', {'le': le}))
+            self.assertEqual(expected, self.registry.get_sample_value('hl_bucket', {'le': le, 'l': 'a'}))
+        self.assertAlmostEqual(sum(amounts), self.registry.get_sample_value('h_sum'))
+
+    def test_observe_many_empty(self):
+        self.histogram.observe_many([])
+        self.assertEqual(0, self.registry.get_sample_value('h_count'))
+
+    def test_sum_and_buckets_share_lock(self):
+        self.assertIs(self.histogram._sum._lock, self.histogram._buckets[0]._lock)
+        self.assertIs(self.histogram._sum._lock, self.histogram._buckets[-1]._lock)
+
     def test_setting_buckets(self):
         h = Histogram('h', 'help', registry=None, buckets=[0, 1, 2])
         self.assertEqual([0.0, 1.0, 2.0, float("inf")], h._upper_bounds)
@@ -334,6 +405,37 @@ class TestHistogram(unittest.TestCase):
         self.assertEqual(1, self.registry.get_sample_value('h_count'))
         self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
 
+    @unittest.skipIf(numpy is None, "Test requires numpy")
+    def test_observe_many_numpy_array(self):
+        self.histogram.observe_many(numpy.array([0.001, 0.5, 0.5, 20, float('nan')]))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '0.005'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_bucket', {'le': '0.5'}))
+        self.assertEqual(4, self.registry.get_sample_value('h_bucket', {'le': '+Inf'}))
+
+
+class TestNumpyImport(unittest.TestCase):
+    def test_not_imported_with_library(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, prometheus_client, prometheus_client.multiprocess; '
+            'prometheus_client.Histogram("h", "help").observe(1); '
+            'print("numpy" in sys.modules)',
+        ], cwd=root)
+        self.assertEqual(b'False', output.strip())
+
+
+class TestHistogramWithoutNumpy(TestHistogram):
+    """Runs the histogram tests without the NumPy fast path."""
+
+    def setUp(self):
+        self._numpy = utils.numpy
+        utils.numpy = None
+        super(TestHistogramWithoutNumpy, self).setUp()
+
+    def tearDown(self):
+        utils.numpy = self._numpy
+
 
 class TestInfo(unittest.TestCase):
     def setUp(self):
@@ -450,6 +552,33 @@ class TestMetricWrapper(unittest.TestCase):
         self.assertRaises(ValueError, self.two_labels.labels)
         self.assertRaises(ValueError, self.two_labels.labels, {'a': 'x'}, b='y')
 
+    def test_labels_return_same_child(self):
+        child = self.two_labels.labels('x', 'y')
+        self.assertIs(child, self.two_labels.labels('x', 'y'))
+        self.assertIs(child, self.two_labels.labels(b='y', a='x'))
+        self.assertIs(self.counter.labels('1'), self.counter.labels(1))
+        self.assertIs(self.counter.labels(l='1'), self.counter.labels(l=1))
+
+    def test_labels_string_subclass_coerced_to_string(self):
+        class Method(str):
+            def __str__(self):
+                return 'Method.GET'
+
+        self.counter.labels('get').inc()
+        self.counter.labels(Method('get')).inc()
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'get'}))
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': 'Method.GET'}))
+
+    def test_labels_unhashable_coerced_to_string(self):
+        self.counter.labels([1]).inc()
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': '[1]'}))
+
+    def test_cached_child(self):
+        child = self.counter.labels('x')
+        child.inc()
+        child.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c_total', {'l': 'x'}))
+
     def test_invalid_names_raise(self):
         self.assertRaises(ValueError, Counter, '', 'help')
         self.assertRaises(ValueError, Counter, '^', 'help')
@@ -696,6 +825,120 @@ class TestCollectorRegistry(unittest.TestCase):
         m.samples = [Sample('s_sum', {}, 7)]
         self.assertEquals([m], registry.restricted_registry(['s_sum']).collect())
 
+    def test_concurrent_collection_keeps_order(self):
+        registry = CollectorRegistry(max_workers=4)
+        for i, delay in enumerate([0.05, 0, 0.02, 0]):
+            registry.register(_SlowCollector('g{0}'.format(i), delay))
+        names = [m.name for m in registry.collect()]
+        self.assertEqual(['g0', 'g1', 'g2', 'g3'], names[:4])
+        self.assertEqual(
+            ['prom_client_collector_duration_seconds', 'prom_client_collector_samples',
+             'prom_client_collector_timeouts', 'prom_client_encoder_duration_seconds'],
+            names[4:])
+
+    def test_concurrent_collection_timeout(self):
+        registry = CollectorRegistry(max_workers=2, collector_timeout=0.05)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        registry.register(_SlowCollector('slow', event=release))
+        registry.register(_SlowCollector('fast'))
+        start = time.time()
+        self.assertEqual(None, registry.get_sample_value('slow'))
+        self.assertEqual(1, registry.get_sample_value('fast'))
+        self.assertLess(time.time() - start, 1)
+        # Including the collection reading the count.
+        self.assertEqual(3, registry.get_sample_value(
+            'prom_client_collector_timeouts_total', {'collector': 'slow'}))
+        self.assertEqual(0, registry.get_sample_value(
+            'prom_client_collector_timeouts_total', {'collector': 'fast'}))
+        self.assertEqual(None, registry.get_sample_value(
+            'prom_client_collector_duration_seconds', {'collector': 'slow'}))
+        self.assertLess(registry.get_sample_value(
+            'prom_client_collector_duration_seconds', {'collector': 'fast'}), 1)
+        # Once it finishes, its output is back.
+        release.set()
+        time.sleep(0.01)
+        self.assertEqual(1, registry.get_sample_value('slow'))
+
+    def test_concurrent_collection_raises(self):
+        registry = CollectorRegistry(max_workers=2)
+
+        class FailingCollector(object):
+            def collect(self):
+                raise ValueError('broken')
+
+        registry.register(FailingCollector())
+        self.assertRaises(ValueError, list, registry.collect())
+
+    def test_instrumented_collection(self):
+        registry = CollectorRegistry(instrument=True)
+        Gauge('g', 'help', ['l'], registry=registry).labels('a').set(1)
+        registry.register(_SlowCollector('slow', 0.02))
+        names = [m.name for m in registry.collect()]
+        self.assertEqual(
+            ['g', 'slow', 'prom_client_collector_duration_seconds', 'prom_client_collector_samples',
+             'prom_client_encoder_duration_seconds'],
+            names)
+        self.assertEqual(1, registry.get_sample_value('prom_client_collector_samples', {'collector': 'g'}))
+        self.assertLessEqual(0.02, registry.get_sample_value(
+            'prom_client_collector_duration_seconds', {'collector': 'slow'}))
+
+    def test_uninstrumented_collection(self):
+        registry = CollectorRegistry()
+        registry.register(_SlowCollector('slow'))
+        self.assertEqual(['slow'], [m.name for m in registry.collect()])
+
+    def test_restricted_registry_is_lazy(self):
+        registry = CollectorRegistry()
+        c = Counter('c_total', 'help', registry=registry)
+        restricted = registry.restricted_registry(['c_total'])
+        c.inc(3)
+        m = Metric('c', 'help', 'counter')
+        m.samples = [Sample('c_total', {}, 3)]
+        self.assertEqual([m], restricted.collect())
+
+    def test_restricted_registry_uses_collect_names(self):
+        registry = CollectorRegistry()
+        requested = []
+
+        class NamedCollector(object):
+            def collect(self):
+                raise AssertionError('collect() should not be called')
+
+            def collect_names(self, names):
+                requested.append(names)
+                return [GaugeMetricFamily('g', 'help', value=1), GaugeMetricFamily('h', 'help', value=2)]
+
+        registry.register(NamedCollector())
+        m = Metric('g', 'help', 'gauge')
+        m.samples = [Sample('g', {}, 1)]
+        self.assertEqual([m], registry.restricted_registry(['g']).collect())
+        self.assertEqual([frozenset(['g'])], requested)
+
+    def test_collect_names(self):
+        h = Histogram('h', 'help', registry=None, buckets=[1])
+        h.observe(2)
+        metrics = h.collect_names(frozenset(['h_count', 'h_bucket']))
+        self.assertEqual(1, len(metrics))
+        self.assertEqual(['h_bucket', 'h_bucket', 'h_count'], [s.name for s in metrics[0].samples])
+        self.assertEqual([], h.collect_names(frozenset(['g'])))
+
+
+class _SlowCollector(object):
+    def __init__(self, name, delay=0, event=None):
+        self.name = name
+        self.delay = delay
+        self.event = event
+
+    def describe(self):
+        return [GaugeMetricFamily(self.name, 'help')]
+
+    def collect(self):
+        time.sleep(self.delay)
+        if self.event is not None:
+            self.event.wait()
+        return [GaugeMetricFamily(self.name, 'help', value=1)]
+
 
 if __name__ == '__main__':
     unittest.main()
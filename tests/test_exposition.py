@@ -1,8 +1,10 @@
 from __future__ import unicode_literals
 
+import socket
 import sys
 import threading
 import time
+import zlib
 
 import pytest
 
@@ -11,11 +13,16 @@ from prometheus_client import (
     Gauge, generate_latest, Histogram, Info, instance_ip_grouping_key, Metric,
     push_to_gateway, pushadd_to_gateway, Summary,
 )
-from prometheus_client import core
-from prometheus_client.core import GaugeHistogramMetricFamily, Timestamp
+from prometheus_client import core, exposition
+from prometheus_client.core import (
+    GaugeHistogramMetricFamily, GaugeMetricFamily, Timestamp,
+)
 from prometheus_client.exposition import (
-    basic_auth_handler, default_handler, MetricsHandler
+    _ThreadingSimpleServer, basic_auth_handler, choose_content_encoding,
+    chunked_encoder, compress_chunks, default_handler, generate_latest_chunks,
+    make_wsgi_app, MetricsHandler,
 )
+from prometheus_client.openmetrics import exposition as openmetrics
 
 if sys.version_info < (2, 7):
     # We need the skip decorators from unittest2 on Python 2.6.
@@ -153,6 +160,35 @@ gh_gsum 7.0
         self.assertEqual(b'# HELP cc A\\ngaug\\\\e\n# TYPE cc gauge\ncc{a="\\\\x\\n\\""} 1.0\n',
                          generate_latest(self.registry))
 
+    def test_cached_prefixes(self):
+        g = Gauge('cc', 'help', ['a', 'b'], registry=self.registry,
+                  multiprocess_mode='all')
+        g.labels('x"', 'y').set(1)
+        g.labels('x"', 'z').set(2)
+        expected = b'# HELP cc help\n# TYPE cc gauge\ncc{a="x\\"",b="y"} 1.0\ncc{a="x\\"",b="z"} 2.0\n'
+        self.assertEqual(expected, generate_latest(self.registry))
+        self.assertEqual(expected, generate_latest(self.registry))
+        g.labels('x"', 'y').set(3)
+        self.assertEqual(expected.replace(b'1.0', b'3.0'), generate_latest(self.registry))
+
+    def test_prefix_cache_follows_series(self):
+        g = Gauge('cc', 'help', ['a'], registry=self.registry,
+                  multiprocess_mode='all')
+        for i in range(5):
+            g.labels(str(i)).set(i)
+        generate_latest(self.registry)
+        self.assertEqual(5, len(exposition._prefix_caches[self.registry]))
+        for i in range(3):
+            g.remove(str(i))
+        output = generate_latest(self.registry)
+        self.assertEqual(2, len(exposition._prefix_caches[self.registry]))
+        self.assertEqual(b'# HELP cc help\n# TYPE cc gauge\ncc{a="3"} 3.0\ncc{a="4"} 4.0\n', output)
+        # Each registry has its own.
+        other = CollectorRegistry()
+        generate_latest(other)
+        self.assertEqual({}, exposition._prefix_caches[other])
+        self.assertEqual(2, len(exposition._prefix_caches[self.registry]))
+
     def test_nonnumber(self):
         class MyNumber(object):
             def __repr__(self):
@@ -246,6 +282,15 @@ class TestPushGateway(unittest.TestCase):
         self.assertEqual(self.requests[0][0].headers.get('content-type'), CONTENT_TYPE_LATEST)
         self.assertEqual(self.requests[0][1], b'# HELP g help\n# TYPE g gauge\ng 0.0\n')
 
+    def test_push_compressed(self):
+        push_to_gateway(self.address, "my_job", self.registry, compression='gzip')
+        self.assertEqual(self.requests[0][0].headers.get('content-encoding'), 'gzip')
+        self.assertEqual(zlib.decompress(self.requests[0][1], 16 + zlib.MAX_WBITS),
+                         b'# HELP g help\n# TYPE g gauge\ng 0.0\n')
+
+    def test_push_unsupported_compression(self):
+        self.assertRaises(ValueError, push_to_gateway, self.address, "my_job", self.registry, compression='br')
+
     def test_pushadd(self):
         pushadd_to_gateway(self.address, "my_job", self.registry)
         self.assertEqual(self.requests[0][0].command, 'POST')
@@ -316,6 +361,227 @@ class TestPushGateway(unittest.TestCase):
         self.assertTrue(issubclass(handler, (MetricsHandler, subclass)))
 
 
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.old_time = time.time
+        time.time = lambda: 123.456
+        Gauge('g', 'help', registry=self.registry)
+        Counter('c', 'help', registry=self.registry).inc()
+
+    def tearDown(self):
+        time.time = self.old_time
+
+    def test_chunk_per_family(self):
+        chunks = list(generate_latest_chunks(self.registry))
+        self.assertEqual([
+            b'# HELP g help\n# TYPE g gauge\ng 0.0\n',
+            b'# HELP c_total help\n# TYPE c_total counter\nc_total 1.0\n# TYPE c_created gauge\nc_created 123.456\n',
+        ], chunks)
+        self.assertEqual(b''.join(chunks), generate_latest(self.registry))
+
+    def test_openmetrics_chunk_per_family(self):
+        chunks = list(openmetrics.generate_latest_chunks(self.registry))
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(b'# EOF\n', chunks[-1])
+        self.assertEqual(b''.join(chunks), openmetrics.generate_latest(self.registry))
+
+    def test_chunked_encoder_of_other_encoder(self):
+        self.assertEqual([b'x'], list(chunked_encoder(lambda registry: b'x')(self.registry)))
+
+    def test_chunked_encoder_records_encoding(self):
+        registry = CollectorRegistry(instrument=True)
+        Gauge('g', 'help', registry=registry)
+        output = b''.join(chunked_encoder(generate_latest)(registry))
+        self.assertIn(b'\ng 0.0\n', output)
+        duration = registry.get_sample_value('prom_client_encoder_duration_seconds', {'encoder': 'text'})
+        self.assertLessEqual(0, duration)
+        list(chunked_encoder(openmetrics.generate_latest)(registry.restricted_registry(['g'])))
+        self.assertNotEqual(None, registry.get_sample_value(
+            'prom_client_encoder_duration_seconds', {'encoder': 'openmetrics'}))
+
+    def test_wsgi_app_streams(self):
+        app = make_wsgi_app(self.registry)
+        responses = []
+        output = app({'QUERY_STRING': ''}, lambda status, headers: responses.append((status, headers)))
+        self.assertFalse(isinstance(output, list))
+        self.assertEqual('200 OK', responses[0][0])
+        self.assertEqual(generate_latest(self.registry), b''.join(output))
+
+    def test_wsgi_app_compresses(self):
+        app = make_wsgi_app(self.registry)
+        responses = []
+        output = app({'QUERY_STRING': '', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                     lambda status, headers: responses.append(headers))
+        self.assertIn(('Content-Encoding', 'gzip'), responses[0])
+        self.assertEqual(generate_latest(self.registry),
+                         zlib.decompress(b''.join(output), 16 + zlib.MAX_WBITS))
+
+    def test_wsgi_app_compression_disabled(self):
+        app = make_wsgi_app(self.registry, compression_level=None)
+        responses = []
+        output = app({'QUERY_STRING': '', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                     lambda status, headers: responses.append(headers))
+        self.assertEqual([('Content-type', CONTENT_TYPE_LATEST)], responses[0])
+        self.assertEqual(generate_latest(self.registry), b''.join(output))
+
+    def _serve(self, handler=None):
+        httpd = _ThreadingSimpleServer(('localhost', 0), handler or MetricsHandler.factory(self.registry))
+        self.addCleanup(httpd.server_close)
+        t = threading.Thread(target=httpd.handle_request)
+        t.daemon = True
+        t.start()
+        return httpd.server_address[1]
+
+    def _request(self, version, headers='', handler=None):
+        port = self._serve(handler)
+        s = socket.create_connection(('localhost', port))
+        self.addCleanup(s.close)
+        s.settimeout(10)
+        s.sendall('GET /metrics {0}\r\nHost: localhost\r\n{1}\r\n'.format(version, headers).encode('ascii'))
+        response = b''
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            response += data
+            if version == 'HTTP/1.1' and response.endswith(b'0\r\n\r\n'):
+                break
+        return response.split(b'\r\n\r\n', 1)
+
+    def test_http_handler_chunked(self):
+        headers, body = self._request('HTTP/1.1')
+        self.assertTrue(headers.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'Transfer-Encoding: chunked', headers)
+        decoded = b''
+        while True:
+            size, body = body.split(b'\r\n', 1)
+            size = int(size, 16)
+            if not size:
+                break
+            decoded += body[:size]
+            body = body[size + 2:]
+        self.assertEqual(generate_latest(self.registry), decoded)
+
+    def test_http_handler_compresses(self):
+        headers, body = self._request('HTTP/1.0', 'Accept-Encoding: deflate\r\n')
+        self.assertIn(b'Content-Encoding: deflate', headers)
+        self.assertEqual(generate_latest(self.registry), zlib.decompress(body))
+
+    def test_http_handler_http10(self):
+        headers, body = self._request('HTTP/1.0')
+        self.assertNotIn(b'Transfer-Encoding', headers)
+        self.assertEqual(generate_latest(self.registry), body)
+
+    def test_http_handler_subclass_closes_connection(self):
+        class Handler(MetricsHandler):
+            def do_GET(self):
+                # No Content-Length, so the end is marked by closing.
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'custom')
+
+        headers, body = self._request('HTTP/1.1', handler=Handler)
+        self.assertTrue(headers.startswith(b'HTTP/1.0 200'))
+        self.assertEqual(b'custom', body)
+
+
+class TestScrapeCache(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.collects = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        test = self
+
+        class SlowCollector(object):
+            def collect(self):
+                test.collects += 1
+                test.started.set()
+                test.release.wait()
+                yield GaugeMetricFamily('slow', 'help', value=test.collects)
+
+        self.registry.register(SlowCollector())
+        self.gauge = Gauge('g', 'help', registry=self.registry)
+
+    def scrape(self, app, query=''):
+        return b''.join(app({'QUERY_STRING': query}, lambda status, headers: None))
+
+    def test_cached_within_ttl(self):
+        app = make_wsgi_app(self.registry, cache_ttl=60)
+        first = self.scrape(app)
+        self.gauge.set(1)
+        self.assertEqual(first, self.scrape(app))
+        self.assertEqual(1, self.collects)
+
+    def test_expires(self):
+        app = make_wsgi_app(self.registry, cache_ttl=60)
+        old_time = time.time
+        try:
+            self.scrape(app)
+            time.time = lambda: old_time() + 61
+            self.gauge.set(1)
+            self.assertIn(b'g 1.0', self.scrape(app))
+        finally:
+            time.time = old_time
+        self.assertEqual(2, self.collects)
+
+    def test_keyed_by_filter(self):
+        app = make_wsgi_app(self.registry, cache_ttl=60)
+        self.scrape(app)
+        self.assertEqual(b'# HELP g help\n# TYPE g gauge\ng 0.0\n', self.scrape(app, 'name[]=g'))
+
+    def test_concurrent_scrapes_share_collection(self):
+        app = make_wsgi_app(self.registry, cache_ttl=60)
+        self.release.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.scrape(app))) for _ in range(4)]
+        threads[0].start()
+        self.started.wait()
+        for t in threads[1:]:
+            t.start()
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, self.collects)
+        self.assertEqual(4, len(results))
+        self.assertEqual(1, len(set(results)))
+
+    def test_errors_not_cached(self):
+        app = make_wsgi_app(self.registry, cache_ttl=60)
+
+        class FailingCollector(object):
+            def collect(self):
+                raise ValueError('broken')
+
+        failing = FailingCollector()
+        self.registry.register(failing)
+        self.assertRaises(ValueError, self.scrape, app)
+        self.registry.unregister(failing)
+        self.assertIn(b'slow', self.scrape(app))
+
+
+class TestContentEncoding(unittest.TestCase):
+    def test_choose_content_encoding(self):
+        self.assertEqual(None, choose_content_encoding(None))
+        self.assertEqual(None, choose_content_encoding('identity'))
+        self.assertEqual('gzip', choose_content_encoding('gzip, deflate'))
+        self.assertEqual('gzip', choose_content_encoding('GZIP'))
+        self.assertEqual('deflate', choose_content_encoding('deflate'))
+        self.assertEqual('deflate', choose_content_encoding('gzip;q=0, deflate;q=0.5'))
+        self.assertEqual('gzip', choose_content_encoding('*'))
+        self.assertEqual(None, choose_content_encoding('*;q=0'))
+
+    def test_compress_chunks(self):
+        chunks = [b'a' * 1000, b'b' * 1000]
+        gzipped = b''.join(compress_chunks(chunks, 'gzip', 1))
+        self.assertEqual(b''.join(chunks), zlib.decompress(gzipped, 16 + zlib.MAX_WBITS))
+        deflated = b''.join(compress_chunks(chunks, 'deflate'))
+        self.assertEqual(b''.join(chunks), zlib.decompress(deflated))
+        self.assertRaises(ValueError, list, compress_chunks(chunks, 'br'))
+
+
 @pytest.fixture
 def registry():
     return core.CollectorRegistry()
@@ -1,23 +1,27 @@
 from __future__ import unicode_literals
 
-from fcntl import LOCK_EX, LOCK_SH
+from fcntl import LOCK_EX, LOCK_NB, LOCK_SH
 import glob
 import os
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 
-from prometheus_client import mmap_dict, values
+from prometheus_client import mmap_arena, mmap_dict, utils, values
 from prometheus_client.core import (
     CollectorRegistry, Counter, Gauge, Histogram, Sample, Summary,
 )
 from prometheus_client.exposition import generate_latest
 import prometheus_client.multiprocess
 from prometheus_client.multiprocess import (
-    advisory_lock, archive_metrics, InMemoryCollector, mark_process_dead,
-    merge, MultiProcessCollector
+    advisory_lock, AdvisoryLock, archive_metrics, FileCache, InMemoryCollector,
+    LockTimeout, mark_process_dead, merge, MultiProcessCollector
 )
+from prometheus_client.multiprocess_exporter import _Watcher
+from prometheus_client.pid_index import PidIndex
 from prometheus_client.values import MultiProcessValue, MutexValue
 
 if sys.version_info < (2, 7):
@@ -40,6 +44,7 @@ class TestMultiProcess(unittest.TestCase):
         return
 
     def tearDown(self):
+        values._flusher.stop()
         del os.environ['prometheus_multiproc_dir']
         shutil.rmtree(self.tempdir)
         values.ValueClass = MutexValue
@@ -64,6 +69,90 @@ class TestMultiProcess(unittest.TestCase):
         self.assertEqual(2, self.registry.get_sample_value('s_count'))
         self.assertEqual(3, self.registry.get_sample_value('s_sum'))
 
+    def test_restricted_registry(self):
+        c = Counter('c', 'help', registry=None)
+        g = Gauge('g', 'help', registry=None)
+        h = Histogram('h', 'help', registry=None, buckets=[1])
+        c.inc(1)
+        g.set(2)
+        h.observe(3)
+        restricted = self.registry.restricted_registry(['c_total', 'h_count'])
+        metrics = sorted(restricted.collect(), key=lambda m: m.name)
+        self.assertEqual(['c', 'h'], [m.name for m in metrics])
+        self.assertEqual([('c_total', 1)], [(s.name, s.value) for s in metrics[0].samples])
+        self.assertEqual([('h_count', 1)], [(s.name, s.value) for s in metrics[1].samples])
+
+    def test_merge_metric_names(self):
+        c = Counter('c', 'help', registry=None)
+        g = Gauge('g', 'help', registry=None)
+        c.inc(1)
+        g.set(2)
+        files = glob.glob(os.path.join(self.tempdir, '*.db'))
+        self.assertEqual(['g'], [m.name for m in merge(files, metric_names={'g'})])
+
+    def test_parallel_merge(self):
+        pid = 0
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        for pid in range(5):
+            Counter('c', 'help', ['l'], registry=None).labels('a').inc(pid)
+            Gauge('g', 'help', registry=None, multiprocess_mode='max').set(pid)
+            Histogram('h', 'help', registry=None).observe(pid)
+        files = glob.glob(os.path.join(self.tempdir, '*.db'))
+
+        def merged(**kwargs):
+            return dict((m.name, sorted(m.samples, key=lambda s: (s.name, sorted(s.labels.items()))))
+                        for m in merge(files, **kwargs))
+
+        self.assertEqual(merged(), merged(processes=3))
+        self.assertEqual(10, merged(processes=3)['c'][0].value)
+        self.assertEqual(['c'], list(merged(processes=3, metric_names={'c'})))
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), "Test requires os.register_at_fork.")
+    def test_parallel_collect_leaves_directory_unchanged(self):
+        values.ValueClass = MultiProcessValue()
+        Counter('c', 'help', registry=None).inc()
+        Gauge('g', 'help', registry=None, multiprocess_mode='min').set(3)
+
+        def listing():
+            return sorted(os.path.relpath(os.path.join(d, f), self.tempdir)
+                          for d, _, fs in os.walk(self.tempdir) for f in fs)
+
+        # Leaves the lockfile.
+        MultiProcessCollector(None, self.tempdir).collect()
+        before = listing()
+        # Start a new pool, with workers forked from this test's values.
+        prometheus_client.multiprocess._close_pools()
+        collector = MultiProcessCollector(None, self.tempdir, processes=2)
+        for _ in range(2):
+            metrics = dict((m.name, m) for m in collector.collect())
+            self.assertEqual(before, listing())
+        self.assertEqual([Sample('g', {}, 3.0)], metrics['g'].samples)
+        self.assertIs(prometheus_client.multiprocess._get_pool(2), prometheus_client.multiprocess._get_pool(2))
+
+    def test_load_folds_gauges(self):
+        pid = 0
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        for pid in range(3):
+            Gauge('gmax', 'help', registry=None, multiprocess_mode='max').set(pid)
+            Gauge('gall', 'help', registry=None, multiprocess_mode='all').set(pid)
+        files = glob.glob(os.path.join(self.tempdir, '*.db'))
+        metrics = prometheus_client.multiprocess.load_metrics_from_files(files)
+        self.assertEqual([Sample('gmax', (), 2.0, None)], metrics['gmax'].samples)
+        self.assertEqual(3, len(metrics['gall'].samples))
+
+    def test_sums_bounded_buffer(self):
+        old_buffer = prometheus_client.multiprocess._SUMS_BUFFER
+        prometheus_client.multiprocess._SUMS_BUFFER = 2
+        self.addCleanup(setattr, prometheus_client.multiprocess, '_SUMS_BUFFER', old_buffer)
+        pid = 0
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        for pid in range(4):
+            c = Counter('c', 'help', ['l'], registry=None)
+            for l in range(pid + 1):
+                c.labels(str(l)).inc()
+        self.assertEqual(4, self.registry.get_sample_value('c_total', {'l': '0'}))
+        self.assertEqual(1, self.registry.get_sample_value('c_total', {'l': '3'}))
+
     def test_histogram_adds(self):
         h1 = Histogram('h', 'help', registry=None)
         values.ValueClass = MultiProcessValue(lambda: 456)
@@ -77,6 +166,15 @@ class TestMultiProcess(unittest.TestCase):
         self.assertEqual(3, self.registry.get_sample_value('h_sum'))
         self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '5.0'}))
 
+    def test_histogram_observation_written(self):
+        h = Histogram('h', 'help', registry=None, buckets=[1, 2])
+        h.observe(1.5)
+        h.observe(float('nan'))
+        self.assertIs(h._sum._lock, h._buckets[1]._lock)
+        self.assertEqual(1, self.registry.get_sample_value('h_count'))
+        self.assertEqual(0, self.registry.get_sample_value('h_bucket', {'le': '1.0'}))
+        self.assertEqual(1, self.registry.get_sample_value('h_bucket', {'le': '2.0'}))
+
     def test_gauge_all(self):
         values.ValueClass = MultiProcessValue(lambda: 123)
         g1 = Gauge('g', 'help', registry=None, multiprocess_mode='all')
@@ -180,7 +278,7 @@ class TestMultiProcess(unittest.TestCase):
         # can not inspect the files cache directly, as it's a closure, so we
         # check for the actual files themselves
         def files():
-            fs = os.listdir(os.environ['prometheus_multiproc_dir'])
+            fs = [f for f in os.listdir(os.environ['prometheus_multiproc_dir']) if f.endswith('.db')]
             fs.sort()
             return fs
 
@@ -192,6 +290,103 @@ class TestMultiProcess(unittest.TestCase):
         c3 = Counter('c3', 'c3', registry=None)
         self.assertEqual(files(), ['counter_0.db', 'counter_1.db'])
 
+    def test_concurrent_increments(self):
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+
+        def work():
+            for _ in range(1000):
+                c.labels('a').inc()
+                c.labels('b').inc(2)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(4000, self.registry.get_sample_value('c_total', {'l': 'a'}))
+        self.assertEqual(8000, self.registry.get_sample_value('c_total', {'l': 'b'}))
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), "Test requires os.register_at_fork.")
+    def test_fork_detected_by_hook(self):
+        values.ValueClass = MultiProcessValue()
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+        child = os.fork()
+        if child == 0:
+            try:
+                c.inc(2)
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
+        self.assertEqual(1, c._value.get())
+        self.assertIn('counter_{0}.db'.format(child), os.listdir(self.tempdir))
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), "Test requires os.register_at_fork.")
+    def test_fork_without_updates_creates_no_files(self):
+        values.ValueClass = MultiProcessValue()
+        g = Gauge('g', 'help', registry=None, multiprocess_mode='min')
+        g.set(3)
+        before = sorted(os.listdir(self.tempdir))
+        pids_before = sorted(PidIndex(self.tempdir).pids())
+        child = os.fork()
+        if child == 0:
+            try:
+                values.flush()
+            finally:
+                os._exit(0)
+        os.waitpid(child, 0)
+        self.assertEqual(before, sorted(os.listdir(self.tempdir)))
+        self.assertEqual(pids_before, sorted(PidIndex(self.tempdir).pids()))
+        self.assertEqual(3, self.registry.get_sample_value('g'))
+
+    def test_buffered_updates_need_flush(self):
+        values.ValueClass = MultiProcessValue(lambda: 123, flush_interval=3600)
+        c = Counter('c', 'help', registry=None)
+        g = Gauge('g', 'help', registry=None, multiprocess_mode='all')
+        c.inc(2)
+        g.set(5)
+        self.assertEqual(2, c._value.get())
+        self.assertEqual(0, self.registry.get_sample_value('c_total'))
+        self.assertEqual(0, self.registry.get_sample_value('g', {'pid': '123'}))
+        values.flush()
+        self.assertEqual(2, self.registry.get_sample_value('c_total'))
+        self.assertEqual(5, self.registry.get_sample_value('g', {'pid': '123'}))
+
+    def test_buffered_updates_flushed_periodically(self):
+        values.ValueClass = MultiProcessValue(lambda: 123, flush_interval=0.01)
+        c = Counter('c', 'help', registry=None)
+        c.inc(3)
+        for _ in range(500):
+            if self.registry.get_sample_value('c_total') == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+
+    def test_buffered_updates_flusher_stops(self):
+        values.ValueClass = MultiProcessValue(lambda: 123, flush_interval=3600)
+        c = Counter('c', 'help', registry=None)
+        c.inc(4)
+        thread = values._flusher._thread
+        self.assertTrue(thread.is_alive())
+        values._flusher.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(4, self.registry.get_sample_value('c_total'))
+
+    def test_buffered_updates_across_forks(self):
+        pid = 0
+        values.ValueClass = MultiProcessValue(lambda: pid, flush_interval=3600)
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+        values.flush()
+        c.inc(1)
+        pid = 1
+        c.inc(1)
+        values.flush()
+        # The parent's unflushed increment stays with the parent.
+        self.assertEqual(2, self.registry.get_sample_value('c_total'))
+        self.assertEqual(1, c._value.get())
+
     @unittest.skipIf(sys.version_info < (2, 7), "Test requires Python 2.7+.")
     def test_collect(self):
         pid = 0
@@ -301,6 +496,81 @@ class TestMultiProcess(unittest.TestCase):
         self.assertEqual(metrics['h'].samples, expected_histogram)
 
 
+    def test_merge_with_file_cache(self):
+        cache = FileCache()
+        c = Counter('c', 'help', labelnames=['l'], registry=None)
+        c.labels('a').inc(1)
+        path = os.path.join(self.tempdir, 'counter_123.db')
+
+        def collect():
+            metrics = dict((m.name, m) for m in merge([path], cache=cache))
+            return sorted(metrics['c'].samples, key=lambda s: s.labels['l'])
+
+        self.assertEqual(collect(), [Sample('c_total', {'l': 'a'}, 1.0)])
+        st = os.stat(path)
+        state = cache._files[st.st_dev, st.st_ino]
+        used = state.used
+        c.labels('a').inc(2)
+        c.labels('b').inc(4)
+        self.assertEqual(collect(), [
+            Sample('c_total', {'l': 'a'}, 3.0),
+            Sample('c_total', {'l': 'b'}, 4.0),
+        ])
+        self.assertIs(state, cache._files[st.st_dev, st.st_ino])
+        self.assertGreater(state.used, used)
+        self.assertEqual(len(state.keys), 2)
+
+    def test_file_cache_detects_replaced_file(self):
+        cache = FileCache()
+        path = os.path.join(self.tempdir, 'counter_123.db')
+        d = mmap_dict.MmapedDict(path)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['a']), 1.0)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['b']), 2.0)
+        d.close()
+        self.assertEqual(len(list(merge([path], cache=cache))[0].samples), 2)
+        os.unlink(path)
+        d = mmap_dict.MmapedDict(path)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['c']), 5.0)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['d']), 6.0)
+        d.write_value(mmap_dict.mmap_key('c', 'c_total', ['l'], ['e']), 7.0)
+        d.close()
+        metric = list(merge([path], cache=cache))[0]
+        self.assertEqual(sorted(metric.samples, key=lambda s: s.labels['l']), [
+            Sample('c_total', {'l': 'c'}, 5.0),
+            Sample('c_total', {'l': 'd'}, 6.0),
+            Sample('c_total', {'l': 'e'}, 7.0),
+        ])
+
+    def test_file_cache_forgets_removed_files(self):
+        cache = FileCache()
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+        path = os.path.join(self.tempdir, 'counter_123.db')
+        merge([path], cache=cache)
+        st = os.stat(path)
+        self.assertIn((st.st_dev, st.st_ino), cache._files)
+        merge([], cache=cache)
+        self.assertEqual({}, cache._files)
+
+    def test_collector_reuses_decoded_keys(self):
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+        self.assertEqual(1, self.registry.get_sample_value('c_total'))
+        state, = self.collector._cache._files.values()
+        layout = state.layout
+        c.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+        self.assertIs(layout, state.layout)
+
+    def test_file_cache_adds_pid_label(self):
+        cache = FileCache()
+        g = Gauge('g', 'help', registry=None, multiprocess_mode='all')
+        g.set(1)
+        path = os.path.join(self.tempdir, 'gauge_all_123.db')
+        for _ in range(2):
+            metric, = merge([path], cache=cache)
+            self.assertEqual(metric.samples, [Sample('g', {'pid': '123'}, 1.0)])
+
     def test_missing_gauge_file_during_merge(self):
         # These files don't exist, just like if mark_process_dead(9999999) had been
         # called during self.collector.collect(), after the glob found it
@@ -312,6 +582,147 @@ class TestMultiProcess(unittest.TestCase):
         ]))
 
 
+class TestMultiProcessWithoutNumpy(TestMultiProcess):
+    """Runs the multiprocess tests without the NumPy fast paths."""
+
+    def setUp(self):
+        self._numpy = utils.numpy
+        utils.numpy = None
+        super(TestMultiProcessWithoutNumpy, self).setUp()
+
+    def tearDown(self):
+        super(TestMultiProcessWithoutNumpy, self).tearDown()
+        utils.numpy = self._numpy
+
+
+class TestArena(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.environ['prometheus_multiproc_dir'] = self.tempdir
+        values.ValueClass = MultiProcessValue(lambda: 123, use_arena=True)
+        self.registry = CollectorRegistry()
+        self.collector = MultiProcessCollector(self.registry, self.tempdir)
+
+    def tearDown(self):
+        del os.environ['prometheus_multiproc_dir']
+        shutil.rmtree(self.tempdir)
+        values.ValueClass = MutexValue
+        prometheus_client.multiprocess._metrics_cache = prometheus_client.multiprocess.MetricsCache()
+
+    def test_single_file(self):
+        c = Counter('c', 'help', registry=None)
+        g = Gauge('g', 'help', registry=None, multiprocess_mode='all')
+        values.ValueClass = MultiProcessValue(lambda: 456, use_arena=True)
+        h = Histogram('h', 'help', registry=None)
+        c.inc(1)
+        g.set(2)
+        h.observe(3)
+        self.assertEqual(os.listdir(self.tempdir), [mmap_arena.ARENA_FILENAME])
+        self.assertEqual(1, self.registry.get_sample_value('c_total'))
+        self.assertEqual(2, self.registry.get_sample_value('g', {'pid': '123'}))
+        self.assertEqual(1, self.registry.get_sample_value('h_count'))
+        self.assertEqual(3, self.registry.get_sample_value('h_sum'))
+
+    def test_counter_adds(self):
+        c1 = Counter('c', 'help', registry=None)
+        values.ValueClass = MultiProcessValue(lambda: 456, use_arena=True)
+        c2 = Counter('c', 'help', registry=None)
+        self.assertEqual(0, self.registry.get_sample_value('c_total'))
+        c1.inc(1)
+        c2.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+
+    def test_gauge_livesum(self):
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
+        values.ValueClass = MultiProcessValue(lambda: 456, use_arena=True)
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
+        g1.set(1)
+        g2.set(2)
+        self.assertEqual(3, self.registry.get_sample_value('g'))
+        mark_process_dead(123, self.tempdir)
+        self.assertEqual(2, self.registry.get_sample_value('g'))
+
+    def test_gauge_livesum_not_freed_while_read(self):
+        g1 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
+        values.ValueClass = MultiProcessValue(lambda: 456, use_arena=True)
+        g2 = Gauge('g', 'help', registry=None, multiprocess_mode='livesum')
+        g1.set(1)
+        g2.set(2)
+
+        def states():
+            arena = mmap_arena.MmapedArena(os.path.join(self.tempdir, mmap_arena.ARENA_FILENAME))
+            try:
+                return sorted(state for _, _, state, _, _ in arena._headers())
+            finally:
+                arena.close()
+
+        # As held by a collector reading the arena.
+        with advisory_lock(LOCK_SH, prom_dir=self.tempdir):
+            mark_process_dead(123, self.tempdir)
+            self.assertEqual(2, self.registry.get_sample_value('g'))
+            self.assertEqual([mmap_arena._IN_USE, mmap_arena._RETIRED], states())
+        archive_metrics(aggregate_only=True)
+        self.assertEqual([mmap_arena._FREE, mmap_arena._IN_USE], states())
+        self.assertEqual(2, self.registry.get_sample_value('g'))
+
+    def test_parallel_merge(self):
+        pid = 0
+        values.ValueClass = MultiProcessValue(lambda: pid, use_arena=True)
+        for pid in range(4):
+            Counter('c', 'help', registry=None).inc(pid)
+            Gauge('g', 'help', registry=None, multiprocess_mode='all').set(pid)
+        collector = MultiProcessCollector(None, self.tempdir, processes=2)
+        metrics = dict((m.name, m) for m in collector.collect())
+        self.assertEqual([Sample('c_total', {}, 6.0)], metrics['c'].samples)
+        self.assertEqual(4, len(metrics['g'].samples))
+
+    def test_segments_grow(self):
+        c = Counter('c', 'help', ['l'], registry=None)
+        for i in range(5000):
+            c.labels(str(i)).inc(i)
+        arena = mmap_arena.MmapedArena(os.path.join(self.tempdir, mmap_arena.ARENA_FILENAME))
+        try:
+            self.assertGreater(len(list(arena.segments())), 1)
+        finally:
+            arena.close()
+        self.assertEqual(4999, self.registry.get_sample_value('c_total', {'l': '4999'}))
+        self.assertEqual(0, self.registry.get_sample_value('c_total', {'l': '0'}))
+
+    def test_archive_frees_dead_segments(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid, use_arena=True)
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+        archive_metrics()
+        self.assertEqual(1, list(InMemoryCollector(None).collect())[0].samples[0].value)
+        self.assertIn('counter.db', os.listdir(os.path.join(self.tempdir, 'archive')))
+        self.assertEqual(set(), prometheus_client.multiprocess._arena_pids(self.tempdir))
+
+        # The freed segment is reused by the next process.
+        pid = 789
+        c = Counter('c', 'help', registry=None)
+        c.inc(2)
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+        archive_metrics(aggregate_only=True)
+        self.assertEqual(3, list(InMemoryCollector(None).collect())[0].samples[0].value)
+        arena = mmap_arena.MmapedArena(os.path.join(self.tempdir, mmap_arena.ARENA_FILENAME))
+        try:
+            self.assertEqual(1, len(list(arena._headers())))
+        finally:
+            arena.close()
+
+    def test_archive_reused_pid(self):
+        values.ValueClass = MultiProcessValue(lambda: 456, use_arena=True)
+        Counter('c', 'help', registry=None).inc(1)
+        archive_metrics()
+        # A new process with the same pid.
+        values.ValueClass = MultiProcessValue(lambda: 456, use_arena=True)
+        Counter('c', 'help', registry=None).inc(5)
+        archive_metrics()
+        self.assertEqual(6, list(InMemoryCollector(None).collect())[0].samples[0].value)
+        self.assertEqual(set(), prometheus_client.multiprocess._arena_pids(self.tempdir))
+
+
 class TestMmapedDict(unittest.TestCase):
     def setUp(self):
         fd, self.tempfile = tempfile.mkstemp()
@@ -346,6 +757,43 @@ class TestMmapedDict(unittest.TestCase):
             [('abc', 42.0, None), (key, 123.0, None), ('def', 17.0, None)],
             list(self.d.read_all_values()))
 
+    def test_read_from_offset(self):
+        self.d.write_value('abc', 42.0)
+        used = self.d._used
+        self.d.write_value('def', 17.0)
+        self.assertEqual(
+            [('def', 17.0, None)],
+            [(k, v, ts) for k, v, ts, _ in self.d._read_all_values(start=used)])
+
+    def test_nonce_is_kept_on_reopen(self):
+        nonce = self.d.nonce
+        self.assertNotEqual(0, nonce)
+        self.d.close()
+        self.d = mmap_dict.MmapedDict(self.tempfile)
+        self.assertEqual(nonce, self.d.nonce)
+
+    def test_read_values(self):
+        self.d.write_value('abc', 42.0)
+        self.d.write_value('a' * 20, 17.0, timestamp=5.0)
+        self.d.write_value('def', 1.5)
+        positions = [pos for _, _, _, pos in self.d._read_all_values()]
+        layout = mmap_dict.ValueLayout(positions[1:])
+        values, timestamps = self.d.read_values(layout)
+        self.assertEqual([17.0, 1.5], list(values))
+        self.assertEqual([5.0, float('inf')], list(timestamps))
+        self.d.write_value('def', 2.5)
+        self.assertEqual([17.0, 2.5], list(self.d.read_values(layout)[0]))
+        self.assertEqual([42.0], list(self.d.read_values(positions[:1])[0]))
+        self.assertEqual(((), ()), self.d.read_values([]))
+
+    def test_read_values_without_numpy(self):
+        numpy = utils.numpy
+        utils.numpy = None
+        try:
+            self.test_read_values()
+        finally:
+            utils.numpy = numpy
+
     def test_corruption_detected(self):
         self.d.write_value('abc', 42.0)
         # corrupt the written data
@@ -357,6 +805,42 @@ class TestMmapedDict(unittest.TestCase):
         os.unlink(self.tempfile)
 
 
+class TestMmapKey(unittest.TestCase):
+    def test_roundtrip(self):
+        key = mmap_dict.mmap_key('m', 'm_total', ('b', 'a'), ('2', ''))
+        self.assertFalse(key.startswith('['))
+        self.assertEqual(
+            ('m', 'm_total', {'a': '', 'b': '2'}), tuple(mmap_dict.decode_key(key)))
+
+    def test_label_order_does_not_matter(self):
+        self.assertEqual(
+            mmap_dict.mmap_key('m', 'm', ('a', 'b'), ('1', '2')),
+            mmap_dict.mmap_key('m', 'm', ('b', 'a'), ('2', '1')))
+
+    def test_decodes_legacy_json_keys(self):
+        key = '["m", "m_total", {"a": "1"}]'
+        self.assertEqual(['m', 'm_total', {'a': '1'}], mmap_dict.decode_key(key))
+
+    def test_separator_in_label_value_falls_back_to_json(self):
+        key = mmap_dict.mmap_key('m', 'm', ('a',), ('x\x00y',))
+        self.assertTrue(key.startswith('['))
+        self.assertEqual(['m', 'm', {'a': 'x\x00y'}], mmap_dict.decode_key(key))
+
+    def test_merge_legacy_and_compact_files(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            legacy = mmap_dict.MmapedDict(os.path.join(tempdir, 'counter_1.db'))
+            legacy.write_value('["c", "c_total", {"a": "1"}]', 1.0)
+            legacy.close()
+            compact = mmap_dict.MmapedDict(os.path.join(tempdir, 'counter_2.db'))
+            compact.write_value(mmap_dict.mmap_key('c', 'c_total', ('a',), ('1',)), 2.0)
+            compact.close()
+            metrics = list(merge(glob.glob(os.path.join(tempdir, '*.db'))))
+            self.assertEqual(metrics[0].samples, [Sample('c_total', {'a': '1'}, 3.0)])
+        finally:
+            shutil.rmtree(tempdir)
+
+
 class TestUnsetEnv(unittest.TestCase):
     def setUp(self):
         self.registry = CollectorRegistry()
@@ -422,12 +906,93 @@ class TestAdvisoryLock(unittest.TestCase):
         # Do an operation which requires acquiring the lock
         archive_metrics(blocking=False)
 
+    def test_lock_timeout(self):
+        start = time.time()
+        with advisory_lock(LOCK_EX):
+            with self.assertRaises(LockTimeout):
+                with advisory_lock(LOCK_SH, timeout=0.05):
+                    pass
+        self.assertLess(time.time() - start, 1)
+        with advisory_lock(LOCK_SH, timeout=0.05):
+            pass
+
+    def test_lock_file_reused(self):
+        lock = AdvisoryLock(os.path.join(self.tempdir, 'lockfile'))
+        f = lock.acquire(LOCK_SH)
+        lock.release(f)
+        g = lock.acquire(LOCK_SH)
+        self.assertIs(f, g)
+        # Held files aren't shared, so locks still exclude each other.
+        self.assertRaises(EnvironmentError, lock.acquire, LOCK_EX | LOCK_NB)
+        lock.release(g)
+
+    def test_collect_falls_back_to_last_result(self):
+        values.ValueClass = MultiProcessValue(lambda: 0)
+        collector = MultiProcessCollector(None, self.tempdir, lock_timeout=0.05)
+        c = Counter('c', 'help', registry=None)
+        c.inc(1)
+
+        def collect():
+            return dict((s.name, s.value) for m in collector.collect() for s in m.samples)
+
+        self.assertEqual({'c_total': 1, 'prom_client_multiprocess_staleness_seconds': 0}, collect())
+        c.inc(1)
+        with advisory_lock(LOCK_EX):
+            stale = collect()
+        self.assertEqual(1, stale['c_total'])
+        self.assertGreater(stale['prom_client_multiprocess_staleness_seconds'], 0)
+        self.assertEqual(2, collect()['c_total'])
+
     def tearDown(self):
         del os.environ['prometheus_multiproc_dir']
         shutil.rmtree(self.tempdir)
         values.ValueClass = MutexValue
 
 
+@unittest.skipIf(not hasattr(os, 'pidfd_open'), "Test requires pidfd_open.")
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = PidIndex(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def start_worker(self, seconds):
+        worker = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep({0})'.format(seconds)])
+        self.addCleanup(worker.wait)
+        return worker
+
+    def test_waits_for_timeout(self):
+        start = time.time()
+        _Watcher(self.tempdir).wait(0.1)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_wakes_when_worker_exits(self):
+        worker = self.start_worker(0.2)
+        self.index.add(worker.pid, 'counter')
+        start = time.time()
+        _Watcher(self.tempdir).wait(10)
+        self.assertLess(time.time() - start, 5)
+
+    def test_tracks_new_workers(self):
+        watcher = _Watcher(self.tempdir)
+        if watcher._inotify is None:
+            self.skipTest("Test requires inotify.")
+        worker = self.start_worker(0.5)
+
+        def start():
+            self.index.add(worker.pid, 'counter')
+            open(os.path.join(self.tempdir, 'counter_{0}.db'.format(worker.pid)), 'w').close()
+
+        timer = threading.Timer(0.1, start)
+        timer.start()
+        self.addCleanup(timer.join)
+        start_time = time.time()
+        watcher.wait(10)
+        self.assertLess(time.time() - start_time, 5)
+
+
 class TestInMemoryCollector(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
@@ -461,6 +1026,156 @@ class TestInMemoryCollector(unittest.TestCase):
         archive_metrics()
         self.assertEqual(self.collector.collect()[0].samples, [Sample('c_total', labels, 1.0)])
 
+    def test_archive_uses_pid_index(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        Gauge('g', 'help', registry=None, multiprocess_mode='max').set(2)
+        index = PidIndex(self.tempdir)
+        self.assertEqual([456], index.pids())
+        self.assertEqual(['counter', 'gauge_max'], index.prefixes(456))
+        archive_metrics()
+        self.assertEqual([], index.pids())
+        self.assertEqual(1, self.registry.get_sample_value('c_total'))
+        self.assertNotIn('counter_456.db', os.listdir(self.tempdir))
+
+    def test_archive_unindexed_files(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        pid = 789
+        Counter('c', 'help', registry=None).inc(2)
+        # As if written by an older version, while 456 is indexed.
+        os.unlink(os.path.join(self.tempdir, 'pids', '789'))
+        archive_metrics()
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+        self.assertNotIn('counter_789.db', os.listdir(self.tempdir))
+
+    def test_archive_stops_scanning_once_indexed(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        archive_metrics()
+        pid = 789
+        Counter('c', 'help', registry=None).inc(2)
+        os.unlink(os.path.join(self.tempdir, 'pids', '789'))
+        archive_metrics()
+        # Not looked for anymore, as there were none on the first pass.
+        self.assertIn('counter_789.db', os.listdir(self.tempdir))
+        self.assertEqual(1, self.registry.get_sample_value('c_total'))
+
+    def test_archive_keeps_index_of_reused_pid(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        index = PidIndex(self.tempdir)
+        archived_pids = prometheus_client.multiprocess._archived_pids
+        self.addCleanup(setattr, prometheus_client.multiprocess, '_archived_pids', archived_pids)
+
+        def reuse_pid(prom_dir):
+            # A new process with the same pid, while the old one's files are archived.
+            index.add(456, 'gauge_max')
+            return archived_pids(prom_dir)
+
+        prometheus_client.multiprocess._archived_pids = reuse_pid
+        prometheus_client.multiprocess.cleanup_processes([456], self.tempdir)
+        self.assertEqual([456], index.pids())
+        self.assertEqual(['gauge_max'], index.prefixes(456))
+        self.assertEqual(['456'], os.listdir(os.path.join(self.tempdir, 'pids')))
+
+    def test_archive_without_pid_index(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        shutil.rmtree(os.path.join(self.tempdir, 'pids'))
+        archive_metrics()
+        self.assertNotIn('counter_456.db', os.listdir(self.tempdir))
+        self.assertEqual(1, self.registry.get_sample_value('c_total'))
+
+    def test_archive_generations(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        archive_metrics()
+        self.assertEqual('archive.1', os.readlink(os.path.join(self.tempdir, 'archive')))
+        self.assertEqual(
+            ['archived_pids', 'counter.db'], sorted(os.listdir(os.path.join(self.tempdir, 'archive'))))
+        pid = 789
+        Counter('c', 'help', registry=None).inc(2)
+        archive_metrics()
+        self.assertEqual('archive.2', os.readlink(os.path.join(self.tempdir, 'archive')))
+        self.assertNotIn('archive.1', os.listdir(self.tempdir))
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+        self.assertEqual(3, list(MultiProcessCollector(None, self.tempdir).collect())[0].samples[0].value)
+
+    def test_archive_batches_dead_workers(self):
+        pid = 0
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        for pid in (456, 457, 458):
+            Counter('c', 'help', registry=None).inc(1)
+            Histogram('h', 'help', registry=None, buckets=[0.5]).observe(pid % 2)
+            Gauge('gmax', 'help', registry=None, multiprocess_mode='max').set(pid)
+            Gauge('gmin', 'help', registry=None, multiprocess_mode='min').set(pid)
+        archive_metrics()
+        # All three in one generation.
+        self.assertEqual('archive.1', os.readlink(os.path.join(self.tempdir, 'archive')))
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+        self.assertEqual(2, self.registry.get_sample_value('h_bucket', {'le': '0.5'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_count'))
+        self.assertEqual(458, self.registry.get_sample_value('gmax'))
+        self.assertEqual(456, self.registry.get_sample_value('gmin'))
+
+        pid = 459
+        c = Counter('c', 'help', ['l'], registry=None)
+        c.labels('new').inc(5)
+        Counter('c', 'help', registry=None).inc(1)
+        Gauge('gmax', 'help', registry=None, multiprocess_mode='max').set(1)
+        Gauge('gmin', 'help', registry=None, multiprocess_mode='min').set(1)
+        archive_metrics()
+        self.assertEqual(4, self.registry.get_sample_value('c_total'))
+        self.assertEqual(5, self.registry.get_sample_value('c_total', {'l': 'new'}))
+        self.assertEqual(3, self.registry.get_sample_value('h_count'))
+        self.assertEqual(458, self.registry.get_sample_value('gmax'))
+        self.assertEqual(1, self.registry.get_sample_value('gmin'))
+
+    def test_archive_reused_pid(self):
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        Counter('c', 'help', registry=None).inc(1)
+        archive_metrics()
+        # A new process with the same pid.
+        values.ValueClass = MultiProcessValue(lambda: 456)
+        Counter('c', 'help', registry=None).inc(5)
+        archive_metrics()
+        self.assertNotIn('counter_456.db', os.listdir(self.tempdir))
+        self.assertEqual(6, self.registry.get_sample_value('c_total'))
+
+    def test_archive_recovers_without_double_counting(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        path = os.path.join(self.tempdir, 'counter_456.db')
+        shutil.copy(path, path + '.bak')
+        archive_metrics()
+        # As if the archiver crashed after switching to the new generation,
+        # before removing the files of the pids merged into it.
+        os.rename(path + '.bak', path)
+        PidIndex(self.tempdir).add(456, 'counter')
+        prometheus_client.multiprocess._write_archived_pids(os.path.join(self.tempdir, 'archive'), [456])
+        archive_metrics()
+        self.assertNotIn('counter_456.db', os.listdir(self.tempdir))
+        self.assertEqual(1, self.registry.get_sample_value('c_total'))
+
+    def test_archive_migrates_legacy_files(self):
+        pid = 456
+        values.ValueClass = MultiProcessValue(lambda: pid)
+        Counter('c', 'help', registry=None).inc(1)
+        os.rename(os.path.join(self.tempdir, 'counter_456.db'), os.path.join(self.tempdir, 'counter.db'))
+        pid = 789
+        Counter('c', 'help', registry=None).inc(2)
+        archive_metrics()
+        self.assertNotIn('counter.db', os.listdir(self.tempdir))
+        self.assertEqual(3, self.registry.get_sample_value('c_total'))
+
     def test_displays_archive_stats(self):
         output = generate_latest(self.registry)
         self.assertIn("archive_duration_seconds", output)